@@ -1,35 +1,695 @@
-# This script causes Wing to auto-save all files every few seconds, as configured,
-# whenever they contain edits.
+# This script causes Wing to auto-save all files a few seconds after typing
+# in them stops, as configured, whenever they contain edits.
 
 # WARNING:  This is not a good idea unless all the files you're editing are in
 # revision control.  Otherwise unintended edits may be saved without any way to
 # find and fix them.
 
+# Saves are spread out over several short timer ticks so that saving many
+# modified files (for example after a project-wide rename) doesn't freeze the
+# user interface.  The document in the active editor is saved first and very
+# large documents wait longer after the last edit.
+
+# With kWriteMode = 'background' the text of each document is captured on the
+# main thread and written by a background thread instead, so slow disks (for
+# example NFS home directories) don't stall the editor.  Files are written to a
+# temporary file, synced to disk in batches and then renamed over the original,
+# and the document is only marked as saved if it wasn't changed in the meantime.
+
+# With kCoalesceSaves = True all documents ready to save in a tick are written
+# to temporary files first and then renamed into place in one quick burst by
+# the background writer, so test runners, build watchers and Wing's own
+# analysis see one set of changes instead of reacting to each file.  If
+# kCommitMarker is set, that file is rewritten after each burst with the list
+# of files that changed, so that watchers can wait for it.
+
+# Files written by the background writer (in 'background' mode or with
+# kCoalesceSaves) are not saved through Wing, so the presave signal is not
+# emitted for them and scripts such as autosavebak.py don't back them up.
+# Only UTF-8 files are written this way; files with another encoding or a
+# PEP 263 coding line for one, and hard linked files, are saved with Wing.
+# Symbolic links are followed.  This needs two things the scripting API
+# lacks: marking the document as saved (the internal SetSavePoint is used) and
+# recording the new modification time of its file, which Wing compares to
+# notice changes made outside of it and would otherwise reload the file or
+# ask about it.  kDiskTimeMethod must name the internal document method that
+# records it in the Wing version used.  If either is missing, files are always
+# saved with Wing.
+
+# With kWriteMode = 'journal' files are never saved automatically.  Instead the
+# edits made to each document are appended to a crash recovery journal in the
+# User Settings Directory, which is compacted when it grows beyond
+# kJournalCompactSize.  After a crash, the unsaved documents in the journal are
+# restored into their editors the next time this script is loaded; if some
+# can't be, the journal is first copied to autosave-journal.unrecovered.  This
+# avoids the dangers mentioned above and the cost of rewriting large files.
+
+# The time and size of each save, the number of saves and remaining backlog
+# per tick and the longest time a tick kept the main loop busy are recorded.
+# A summary is appended to autosave-stats.log in the User Settings Directory
+# every kStatsLogInterval seconds while saving, and the autosave-stats command
+# shows it on demand.
+
 # Written by Stephan Deibel
 
+import os
+import re
+import json
+import time
+import shutil
+import threading
+import collections
+try:
+  import queue
+except ImportError:
+  import Queue as queue
 import wingapi
 
-kSaveFrequency = 5  # seconds
+kIdleDelay = 2.0  # seconds after the last edit before a document is saved
+kLargeFileSize = 1000000  # documents at least this many characters long...
+kLargeFileIdleDelay = 30.0  # ...wait this many seconds instead
+kTickInterval = 250  # milliseconds between checks for documents to save
+kTickBudget = 0.05  # seconds of saving per tick; remaining saves wait for the next tick
+kWriteMode = 'save'  # 'save' to save with Wing on the main thread, 'background' or 'journal'
+kCoalesceSaves = False  # rename all files saved in a tick into place in one burst
+kCommitMarker = None  # e.g. '.autosave-commit'; relative paths are in the project directory
+kDiskTimeMethod = None  # internal document method taking the file's new mtime; see above
+kJournalCompactSize = 4000000  # bytes of journal before it is compacted
+kJournalSyncInterval = 5.0  # minimum seconds between fsyncs of the journal
+kStatsWindow = 1000  # number of recent saves and ticks the statistics cover
+kStatsLogInterval = 300  # seconds between summaries in the log; 0 to disable
+
 gPendingSaves = {}
+gLastEdit = {}
+gEditCount = {}  # filename -> number of edits, to tell if a snapshot is still current
+gInFlight = {}  # filename -> (doc, edit count) for snapshots being written
+gSaveFallback = set()  # filenames to save with Wing after a background write failed
+gWingSaveOnly = set()  # filenames the background writer can't write correctly
+gCanMarkSaved = None  # whether documents written in the background can be marked saved
+gWriter = None
+gResults = queue.Queue()  # (filename, edit count, error, bytes, seconds, mtime) for written snapshots
+gJournal = None
 
 def _connect_to_document(doc):
   def _on_modified(savepoint):
+    fn = doc.GetFilename()
     if savepoint:
+      gPendingSaves.pop(fn, None)
+      gLastEdit.pop(fn, None)
+      if gJournal is not None:
+        gJournal.drop(fn)
+      return
+    if gJournal is not None:
       return
-    gPendingSaves[doc.GetFilename()] = doc
+    gPendingSaves[fn] = doc
+    gLastEdit[fn] = time.time()
+  def _on_edit(insert, pos, length, text, *args):
+    fn = doc.GetFilename()
+    gEditCount[fn] = gEditCount.get(fn, 0) + 1
+    if gJournal is not None:
+      gJournal.record(fn, doc, insert, pos, length, text)
+    elif fn in gPendingSaves or fn in gInFlight:
+      gPendingSaves[fn] = doc
+      gLastEdit[fn] = time.time()
+  def _on_destroy(*args):
+    fn = doc.GetFilename()
+    gPendingSaves.pop(fn, None)
+    gLastEdit.pop(fn, None)
+    gEditCount.pop(fn, None)
+    gInFlight.pop(fn, None)
+    if gJournal is not None:
+      gJournal.drop(fn)
   connect_id = doc.Connect('save-point', _on_modified)
+  doc.Connect('modified', _on_edit)
+  doc.Connect('destroy', _on_destroy)
 
-def _do_saves():
+def _ready_saves():
+  """Get the pending documents that have been idle long enough to save, in
+  the order they should be saved"""
+  now = time.time()
+  active_fn = None
+  editor = wingapi.gApplication.GetActiveEditor()
+  if editor is not None:
+    active_fn = editor.GetDocument().GetFilename()
+  ready = []
   for fn, doc in gPendingSaves.items():
+    if doc.GetLength() >= kLargeFileSize:
+      delay = kLargeFileIdleDelay
+    else:
+      delay = kIdleDelay
+    last_edit = gLastEdit.get(fn, 0)
+    if now - last_edit >= delay:
+      ready.append((fn != active_fn, last_edit, fn))
+  ready.sort()
+  return [fn for is_inactive, last_edit, fn in ready]
+
+def _replace(src, dst):
+  """Rename src over dst, which os.rename only does atomically on POSIX"""
+  if hasattr(os, 'replace'):
+    os.replace(src, dst)
+  else:
+    if os.name == 'nt' and os.path.exists(dst):
+      os.remove(dst)
+    os.rename(src, dst)
+
+def _write_marker(marker, filenames):
+  tmp_fn = marker + '.tmp'
+  f = open(tmp_fn, 'w')
+  try:
+    json.dump({'time': time.time(), 'files': filenames}, f)
+  finally:
+    f.close()
+  _replace(tmp_fn, marker)
+
+class _NeedsWingSave(Exception):
+  """Raised for files the background writer would not write correctly: files
+  that aren't UTF-8 and hard linked files"""
+
+# Files the background writer found to be UTF-8 already
+gCheckedUtf8 = set()
+
+def _check_writable(fn, st):
+  """Raise _NeedsWingSave if file fn with stat result st (fn being the real
+  path) should be saved by Wing"""
+  if st.st_nlink > 1:
+    raise _NeedsWingSave("%s has hard links" % fn)
+  if fn in gCheckedUtf8:
+    return
+  f = open(fn, 'rb')
+  try:
+    data = f.read()
+  finally:
+    f.close()
+  if data.startswith(b'\xef\xbb\xbf'):
+    raise _NeedsWingSave("%s starts with a byte order mark" % fn)
+  try:
+    data.decode('utf-8')
+  except UnicodeDecodeError:
+    raise _NeedsWingSave("%s is not UTF-8" % fn)
+  gCheckedUtf8.add(fn)
+
+def _write_batch(jobs, marker=None):
+  """Write a batch of (filename, text, edit count) snapshots: write all temp
+  files, fsync them, rename them over the originals in one burst and finally
+  fsync the directories and write the marker file, if any.  Symbolic links
+  are followed so the file they point to is replaced, and the file's mode and
+  owner are kept.  Only UTF-8 files without hard links are written; others
+  fail with _NeedsWingSave.  Returns a list of (filename, edit count, error
+  or None, bytes written, seconds spent, new modification time or None)."""
+  results = []
+  written = []
+  for fn, text, count in jobs:
+    start = time.time()
+    real_fn = os.path.realpath(fn)
+    dirname, basename = os.path.split(real_fn)
+    tmp_fn = os.path.join(dirname, '.%s.autosave~' % basename)
+    try:
+      st = None
+      if os.path.exists(real_fn):
+        st = os.stat(real_fn)
+        _check_writable(real_fn, st)
+      data = text.encode('utf-8')
+      f = open(tmp_fn, 'wb')
+      try:
+        f.write(data)
+        f.flush()
+        if st is not None:
+          os.chmod(tmp_fn, st.st_mode & 0o7777)
+          if hasattr(os, 'chown') and st.st_uid != os.stat(tmp_fn).st_uid:
+            os.chown(tmp_fn, st.st_uid, st.st_gid)
+      except Exception:
+        f.close()
+        if os.path.exists(tmp_fn):
+          os.remove(tmp_fn)
+        raise
+      written.append((real_fn, fn, tmp_fn, count, f, len(data), time.time() - start))
+    except Exception as exc:
+      results.append((fn, count, exc, 0, time.time() - start, None))
+  synced = []
+  for real_fn, fn, tmp_fn, count, f, size, elapsed in written:
+    start = time.time()
+    try:
+      try:
+        os.fsync(f.fileno())
+      finally:
+        f.close()
+      synced.append((real_fn, fn, tmp_fn, count, size, elapsed + time.time() - start))
+    except Exception as exc:
+      results.append((fn, count, exc, 0, elapsed + time.time() - start, None))
+  dirnames = set()
+  for real_fn, fn, tmp_fn, count, size, elapsed in synced:
+    start = time.time()
+    try:
+      _replace(tmp_fn, real_fn)
+      dirnames.add(os.path.dirname(real_fn))
+      mtime = os.stat(real_fn).st_mtime
+      results.append((fn, count, None, size, elapsed + time.time() - start, mtime))
+    except Exception as exc:
+      results.append((fn, count, exc, 0, elapsed + time.time() - start, None))
+  if hasattr(os, 'O_DIRECTORY'):
+    for dirname in dirnames:
+      try:
+        fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+          os.fsync(fd)
+        finally:
+          os.close(fd)
+      except OSError:
+        pass
+  if marker is not None and dirnames:
+    try:
+      _write_marker(marker, [r[0] for r in results if r[2] is None])
+    except (IOError, OSError):
+      pass
+  return results
+
+class _BackgroundWriter(threading.Thread):
+  """Writes the (snapshots, marker) batches queued by the main thread,
+  merging batches that queued up while it was busy.  Results are queued back
+  and handled on the main thread by _finish_writes()."""
+
+  def __init__(self):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.jobs = queue.Queue()
+
+  def run(self):
+    while True:
+      snapshots, marker = self.jobs.get()
+      snapshots = list(snapshots)
+      while True:
+        try:
+          more, marker = self.jobs.get_nowait()
+        except queue.Empty:
+          break
+        snapshots.extend(more)
+      # Merged batches may hold several snapshots of a file; write the latest
+      latest = collections.OrderedDict()
+      for snapshot in snapshots:
+        if snapshot[0] not in latest or latest[snapshot[0]][2] < snapshot[2]:
+          latest[snapshot[0]] = snapshot
+      for result in _write_batch(list(latest.values()), marker):
+        gResults.put(result)
+
+def _mark_saved(doc):
+  """Mark a document whose text was written by the background writer as
+  saved.  The scripting API has no call for this, so the internal document is
+  used like editor.fEditor is elsewhere; _check_mark_saved() makes sure it
+  can be."""
+  doc.fDocument.SetSavePoint()
+
+def _record_disk_time(doc, mtime):
+  """Tell Wing the file of a document was written with the given
+  modification time, so it isn't taken for a change made outside of Wing"""
+  getattr(doc.fDocument, kDiskTimeMethod)(mtime)
+
+def _check_mark_saved(doc):
+  """Check once whether documents can be marked saved and their file times
+  recorded without saving them.  If not, writing in the background would
+  still need a save with Wing on the main thread afterwards, or make Wing
+  report the files as changed on disk, so background writes are turned off."""
+  global gCanMarkSaved
+  if gCanMarkSaved is not None:
+    return gCanMarkSaved
+  fdoc = getattr(doc, 'fDocument', None)
+  gCanMarkSaved = (callable(getattr(fdoc, 'SetSavePoint', None))
+                   and kDiskTimeMethod is not None
+                   and callable(getattr(fdoc, kDiskTimeMethod, None)))
+  if not gCanMarkSaved:
+    wingapi.gApplication.ShowMessageDialog(
+      "Autosave", "This version of Wing can't mark documents as saved and record "
+      "the time their files were written from a script (see kDiskTimeMethod), so "
+      "background writing and coalesced saves are disabled and files are saved "
+      "with Wing instead.")
+  return gCanMarkSaved
+
+def _use_writer():
+  """Whether documents are written by the background writer"""
+  return kWriteMode == 'background' or (kWriteMode == 'save' and kCoalesceSaves)
+
+def _finish_writes():
+  while True:
+    try:
+      fn, count, error, size, elapsed, mtime = gResults.get_nowait()
+    except queue.Empty:
+      return
+    if error is None:
+      gStats.add_save(elapsed, size)
+    doc, snapshot_count = gInFlight.get(fn, (None, None))
+    if error is None and doc is not None:
+      # Also when the document changed since, so Wing doesn't reload it
+      _record_disk_time(doc, mtime)
+    if snapshot_count != count:
+      continue
+    del gInFlight[fn]
+    if error is not None:
+      if isinstance(error, _NeedsWingSave):
+        gWingSaveOnly.add(fn)
+      gSaveFallback.add(fn)
+      gPendingSaves[fn] = doc
+      gLastEdit.setdefault(fn, 0)
+    elif fn not in gPendingSaves and gEditCount.get(fn, 0) == count:
+      _mark_saved(doc)
+
+def _save(fn, doc):
+  """Save a document with Wing, or return a (filename, text, edit count)
+  snapshot of it to pass to _commit()"""
+  if (not _use_writer() or fn in gSaveFallback or fn in gWingSaveOnly
+      or not _check_mark_saved(doc) or _declared_encoding(doc) not in (None, 'utf-8', 'utf8')):
+    gSaveFallback.discard(fn)
+    start = time.time()
     doc.Save()
-  gPendingSaves.clear()
+    gStats.add_save(time.time() - start, doc.GetLength())
+    return None
+  count = gEditCount.get(fn, 0)
+  gInFlight[fn] = (doc, count)
+  return (fn, doc.GetText(), count)
+
+_kCodingRE = re.compile(r'^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)', re.MULTILINE)
+
+def _declared_encoding(doc):
+  """Return the lower case PEP 263 encoding declared in the first two lines
+  of a document, or None"""
+  head = doc.GetCharRange(0, min(doc.GetLength(), 400))
+  match = _kCodingRE.search('\n'.join(head.split('\n')[:2]))
+  if match is None:
+    return None
+  return match.group(1).lower().replace('_', '-')
+
+def _marker_filename():
+  if kCommitMarker is None or os.path.isabs(kCommitMarker):
+    return kCommitMarker
+  project_fn = wingapi.gApplication.GetProject().GetFilename()
+  if not project_fn or not os.path.isabs(project_fn):
+    return None
+  return os.path.join(os.path.dirname(project_fn), kCommitMarker)
+
+def _commit(snapshots):
+  global gWriter
+  if gWriter is None:
+    gWriter = _BackgroundWriter()
+    gWriter.start()
+  gWriter.jobs.put((snapshots, _marker_filename()))
+
+def _replay(base, ops, length):
+  """Apply journaled edits to base text.  Positions from Wing may count
+  characters or UTF-8 bytes, so the result's length is checked against the
+  journaled document length and bytes are tried if characters don't fit.
+  Returns None if neither does."""
+  for as_bytes in (False, True):
+    txt = base.encode('utf-8') if as_bytes else base
+    for op in ops:
+      if op[0] == 'i':
+        ins = op[2].encode('utf-8') if as_bytes else op[2]
+        txt = txt[:op[1]] + ins + txt[op[1]:]
+      else:
+        txt = txt[:op[1]] + txt[op[1] + op[2]:]
+    if length is None or len(txt) == length:
+      if not as_bytes:
+        return txt
+      try:
+        return txt.decode('utf-8')
+      except UnicodeDecodeError:
+        return None  # A position was inside a character
+  return None
+
+class _Journal:
+  """Append-only journal of the edits made to unsaved documents.  Each line
+  is a JSON object for one file: {"base": text} starts a new chain of edits
+  with the full text, {"ops": [...], "len": n} holds the edits since the last
+  line for the file and {"clean": 1} ends the chain when the document is saved
+  or closed."""
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.ops = {}  # filename -> (doc, edits not yet written)
+    self.chains = set()  # filenames with a base in the journal
+    self.file = None
+    self.last_sync = 0
+
+  def record(self, fn, doc, insert, pos, length, text):
+    doc_ops = self.ops.setdefault(fn, (doc, []))[1]
+    if insert:
+      doc_ops.append(['i', pos, text])
+    else:
+      doc_ops.append(['d', pos, length])
+
+  def drop(self, fn):
+    self.ops.pop(fn, None)
+    if fn in self.chains:
+      self.chains.discard(fn)
+      self._write([{'f': fn, 'clean': 1}])
+
+  def flush(self):
+    if not self.ops:
+      return
+    entries = []
+    for fn, (doc, doc_ops) in self.ops.items():
+      if fn in self.chains:
+        entries.append({'f': fn, 'ops': doc_ops, 'len': doc.GetLength()})
+      else:
+        # The edits made before the first flush are part of the base text
+        entries.append({'f': fn, 'base': doc.GetText()})
+        self.chains.add(fn)
+    self.ops.clear()
+    start = time.time()
+    size = self._write(entries)
+    gStats.add_save(time.time() - start, size)
+    if self.file.tell() > kJournalCompactSize:
+      self.compact()
+
+  def _write(self, entries):
+    if self.file is None:
+      self.file = open(self.filename, 'ab')
+    size = 0
+    for entry in entries:
+      data = json.dumps(entry).encode('utf-8') + b'\n'
+      self.file.write(data)
+      size += len(data)
+    self.file.flush()
+    if time.time() - self.last_sync >= kJournalSyncInterval:
+      os.fsync(self.file.fileno())
+      self.last_sync = time.time()
+    return size
+
+  def compact(self):
+    """Rewrite the journal with only the current text of unsaved documents"""
+    docs = {}
+    for doc in wingapi.gApplication.GetOpenDocuments():
+      docs[doc.GetFilename()] = doc
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+    tmp_fn = self.filename + '.tmp'
+    f = open(tmp_fn, 'wb')
+    try:
+      for fn in sorted(self.chains | set(self.ops)):
+        if fn in docs:
+          entry = {'f': fn, 'base': docs[fn].GetText()}
+          f.write(json.dumps(entry).encode('utf-8') + b'\n')
+      f.flush()
+      os.fsync(f.fileno())
+    finally:
+      f.close()
+    _replace(tmp_fn, self.filename)
+    self.chains = set([fn for fn in self.chains | set(self.ops) if fn in docs])
+    self.ops.clear()
+
+  def read(self):
+    """Return {filename: text} for the unsaved documents in the journal, or
+    None as text for documents whose edits could not be replayed"""
+    chains = {}
+    if not os.path.exists(self.filename):
+      return chains
+    f = open(self.filename, 'rb')
+    try:
+      for line in f:
+        try:
+          entry = json.loads(line.decode('utf-8'))
+        except ValueError:
+          break  # Partly written last line
+        fn = entry['f']
+        if 'clean' in entry:
+          chains.pop(fn, None)
+        elif 'base' in entry:
+          chains[fn] = (entry['base'], [], None)
+        elif fn in chains:
+          base, ops, length = chains[fn]
+          chains[fn] = (base, ops + entry['ops'], entry['len'])
+    finally:
+      f.close()
+    recovered = {}
+    for fn, (base, ops, length) in chains.items():
+      recovered[fn] = _replay(base, ops, length)
+    return recovered
+
+def _keep_unrecovered(filename):
+  """Copy the journal aside before edits that couldn't be restored are
+  compacted away, and return the copy's name"""
+  keep_fn = filename + '.unrecovered'
+  if os.path.exists(keep_fn):
+    keep_fn += '.%d' % int(time.time())
+  shutil.copyfile(filename, keep_fn)
+  return keep_fn
+
+def _recover_from_journal():
+  app = wingapi.gApplication
+  restored = []
+  failed = []
+  for fn, txt in sorted(gJournal.read().items()):
+    if txt is None:
+      failed.append(fn)
+      continue
+    editor = app.OpenEditor(fn)
+    if editor is None:
+      failed.append(fn)
+      continue
+    doc = editor.GetDocument()
+    if doc.GetText() != txt:
+      doc.SetText(txt)
+      restored.append(fn)
+  keep_fn = None
+  if failed:
+    keep_fn = _keep_unrecovered(gJournal.filename)
+  # Documents that are already unsaved (for example when the script is
+  # reloaded) have no edits recorded yet, so keep their text in the journal
+  for doc in app.GetOpenDocuments():
+    if not doc.IsSavePoint():
+      gJournal.chains.add(doc.GetFilename())
+  gJournal.compact()
+  if restored or failed:
+    msg = ''
+    if restored:
+      msg += "Restored unsaved changes to:\n\n%s\n\n" % '\n'.join(restored)
+    if failed:
+      msg += "Could not restore unsaved changes to:\n\n%s\n\n" % '\n'.join(failed)
+      msg += "The journal was kept in %s\n" % keep_fn
+    app.ShowMessageDialog("Autosave recovery", msg)
+
+class _Stats:
+  """Rolling statistics for the most recent saves and ticks"""
+
+  # Upper bounds of the save latency histogram buckets, in milliseconds
+  kBuckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+  def __init__(self):
+    self.saves = collections.deque(maxlen=kStatsWindow)  # (seconds, bytes)
+    self.ticks = collections.deque(maxlen=kStatsWindow)  # (seconds, saves, backlog)
+    self.total_saves = 0
+    self.total_bytes = 0
+    self.longest_stall = 0.0
+    self.tick_saves = 0
+    self.last_log = time.time()
+
+  def add_save(self, elapsed, size):
+    self.saves.append((elapsed, size))
+    self.total_saves += 1
+    self.total_bytes += size
+    self.tick_saves += 1
+
+  def add_tick(self, elapsed, backlog):
+    if self.tick_saves or backlog:
+      self.ticks.append((elapsed, self.tick_saves, backlog))
+    self.longest_stall = max(self.longest_stall, elapsed)
+    self.tick_saves = 0
+
+  def summary(self):
+    lines = ["Autosave statistics (%s mode, %s)" % (kWriteMode, time.strftime('%Y-%m-%d %H:%M:%S')),
+             "Total: %d saves, %d bytes" % (self.total_saves, self.total_bytes),
+             "Longest main loop stall: %.1f ms" % (self.longest_stall * 1000)]
+    if self.saves:
+      times = sorted([elapsed for elapsed, size in self.saves])
+      sizes = [size for elapsed, size in self.saves]
+      def pct(p):
+        return times[min(len(times) - 1, int(len(times) * p))] * 1000
+      lines.append("Last %d saves: %d bytes, mean %.1f ms, median %.1f ms, 95%% %.1f ms, max %.1f ms"
+                   % (len(times), sum(sizes), sum(times) * 1000 / len(times), pct(0.5),
+                      pct(0.95), times[-1] * 1000))
+      counts = [0] * (len(self.kBuckets) + 1)
+      for elapsed in times:
+        i = 0
+        while i < len(self.kBuckets) and elapsed * 1000 >= self.kBuckets[i]:
+          i += 1
+        counts[i] += 1
+      lines.append("Save latency histogram:")
+      lower = 0
+      for i, count in enumerate(counts):
+        if i < len(self.kBuckets):
+          label = "%5d - %5d ms" % (lower, self.kBuckets[i])
+          lower = self.kBuckets[i]
+        else:
+          label = "%5d ms and up " % lower
+        if count:
+          lines.append("  %s: %d" % (label, count))
+    if self.ticks:
+      tick_times = [elapsed for elapsed, saves, backlog in self.ticks]
+      lines.append("Last %d busy ticks: mean %.1f ms, max %.1f ms, max %d saves per tick, max backlog %d"
+                   % (len(self.ticks), sum(tick_times) * 1000 / len(tick_times),
+                      max(tick_times) * 1000, max([t[1] for t in self.ticks]),
+                      max([t[2] for t in self.ticks])))
+    return '\n'.join(lines)
+
+  def maybe_log(self):
+    if not kStatsLogInterval or time.time() - self.last_log < kStatsLogInterval:
+      return
+    self.last_log = time.time()
+    if not self.saves:
+      return
+    filename = os.path.join(wingapi.gApplication.GetUserSettingsDir(), 'autosave-stats.log')
+    try:
+      f = open(filename, 'a')
+      try:
+        f.write(self.summary() + '\n\n')
+      finally:
+        f.close()
+    except (IOError, OSError):
+      pass
+
+gStats = _Stats()
+
+def autosave_stats():
+  """Show statistics about recent autosaves and how long they kept the
+  user interface busy"""
+  wingapi.gApplication.ShowMessageDialog("Autosave Statistics", gStats.summary())
+
+autosave_stats.label = "Show Autosave Statistics"
+
+def _do_saves():
+  start = time.time()
+  if gJournal is not None:
+    gJournal.flush()
+  else:
+    _finish_writes()
+    deadline = start + kTickBudget
+    snapshots = []
+    for fn in _ready_saves():
+      doc = gPendingSaves.pop(fn)
+      gLastEdit.pop(fn, None)
+      snapshot = _save(fn, doc)
+      if snapshot is not None:
+        snapshots.append(snapshot)
+      # Capturing text is quick, so all documents go into one coalesced batch
+      if time.time() >= deadline and not kCoalesceSaves:
+        break
+    if snapshots:
+      _commit(snapshots)
+  gStats.add_tick(time.time() - start, len(gPendingSaves))
+  gStats.maybe_log()
   return True  # Keep calling this
-  
+
 def _init():
+  global gJournal
+  if kWriteMode == 'journal':
+    filename = os.path.join(wingapi.gApplication.GetUserSettingsDir(), 'autosave-journal')
+    gJournal = _Journal(filename)
   wingapi.gApplication.Connect('document-open', _connect_to_document)
   for doc in wingapi.gApplication.GetOpenDocuments():
     _connect_to_document(doc)
-    
-  wingapi.gApplication.InstallTimeout(kSaveFrequency*1000, _do_saves)
+    if _use_writer():
+      _check_mark_saved(doc)
+  if gJournal is not None:
+    _recover_from_journal()
+
+  wingapi.gApplication.InstallTimeout(kTickInterval, _do_saves)
 
 _init()
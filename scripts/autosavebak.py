@@ -1,27 +1,907 @@
-# Simple script that make a copy of any saved file to a *.bak before overwriting 
+# Simple script that make a copy of any saved file to a *.bak before overwriting
 # it with newly saved content
 
+# The copy is made in binary mode with the fastest copy the OS offers (a
+# reflink on file systems that support it, otherwise copy_file_range or
+# sendfile) and is skipped if the *.bak file already has the same content.
+# The benchmark-bak-copy command shows how long each way of copying takes for
+# large files.
+
+# With kBackupMode = 'store' no *.bak files are written.  Instead each version
+# of a file is kept compressed in a backup store under kBackupDir, stored only
+# once per distinct content, with an index of the versions of each file.  Old
+# versions are removed according to kKeepVersions, kKeepDays and
+# kMaxStoreSize.  The list-backups command lists the versions of the file in
+# the current editor and restore-backup puts one of them into the editor.
+# Files of at least kDeltaMinSize bytes are stored as rsync style deltas of
+# the blocks that changed since the previous version, with a full copy every
+# kDeltaFullEvery versions, so backing them up writes about as much as was
+# edited.
+
+# With kAsyncBackup the save only waits for a snapshot of the old file to be
+# taken, synced to disk and queued; the backup itself is finished on a
+# background thread.  The snapshot is only quick where it can be a reflink
+# (e.g. Btrfs, XFS, APFS) or, with kUseHardlink, a hard link; on other file
+# systems such as ext4 or NFS it is a full copy made during the save, which
+# costs about as much as a synchronous backup.
+
+import os
+import sys
+import gzip
+import json
+import mmap
+import time
+import zlib
+import errno
+import shutil
+import struct
+import hashlib
+import tempfile
+import threading
+try:
+  import queue
+except ImportError:
+  import Queue as queue
 import wingapi
 
+kBackupMode = 'bak'  # 'bak' for a *.bak next to each file or 'store'
+kBackupDir = None  # backup store location; defaults to 'backups' in the User Settings Directory
+kKeepVersions = 50  # versions kept per file; 0 for no limit
+kKeepDays = 30  # days versions are kept; 0 for no limit
+kMaxStoreSize = 500 * 1024 * 1024  # bytes of compressed content in the store; 0 for no limit
+kCompressLevel = 6
+kCollectInterval = 3600  # minimum seconds between removals of unused objects while under kMaxStoreSize
+kDeltaMinSize = 16 * 1024 * 1024  # files this large are stored as deltas; 0 to disable
+kDeltaBlockSize = 64 * 1024  # block size for delta matching; changing it forces full copies
+kDeltaFullEvery = 20  # store a full copy after this many deltas in a row
+kDeltaMaxLiteral = 0.5  # store a full copy if more than this fraction of the file changed
+
+# Capture the old file before saving and finish the backup on a background
+# thread instead of making the save wait for it.  The snapshots are written
+# next to the saved files as *.bak-<pid>-<time>.tmp until they are backed up,
+# which file watchers will notice.
+kAsyncBackup = False
+
+# Make the *.bak file a hard link to the old file instead of copying it.  This
+# is only safe if saving replaces the file with a new one instead of
+# rewriting it in place, since the *.bak would otherwise change along with it.
+kUseHardlink = False
+
+kCopyChunkSize = 1 << 24
+
+# File sizes in MB used by benchmark-bak-copy
+kBenchmarkSizes = (10, 100, 500)
+
+# Errors from a copy method that mean it isn't supported for the file system
+kUnsupportedErrors = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                      errno.ENOTTY, errno.EBADF)
+
+# (st_dev, method name) for copy methods that failed on a device
+gUnsupported = set()
+
+def _copy_reflink(src_fd, dst_fd, size):
+  import fcntl
+  FICLONE = 0x40049409
+  fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+def _copy_file_range(src_fd, dst_fd, size):
+  offset = 0
+  while offset < size:
+    copied = os.copy_file_range(src_fd, dst_fd, min(kCopyChunkSize, size - offset), offset, offset)
+    if copied == 0:
+      # Some file systems (e.g. procfs) report nothing to copy
+      raise OSError(errno.EINVAL, "copy_file_range copied %d of %d bytes" % (offset, size))
+    offset += copied
+
+def _copy_sendfile(src_fd, dst_fd, size):
+  offset = 0
+  while offset < size:
+    sent = os.sendfile(dst_fd, src_fd, offset, min(kCopyChunkSize, size - offset))
+    if sent == 0:
+      raise OSError(errno.EINVAL, "sendfile copied %d of %d bytes" % (offset, size))
+    offset += sent
+
+def _copy_userspace(src_fd, dst_fd, size):
+  while True:
+    data = os.read(src_fd, kCopyChunkSize)
+    if not data:
+      break
+    while data:
+      written = os.write(dst_fd, data)
+      data = data[written:]
+
+kCopyMethods = [('reflink', _copy_reflink)]
+if hasattr(os, 'copy_file_range'):
+  kCopyMethods.append(('copy_file_range', _copy_file_range))
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+  kCopyMethods.append(('sendfile', _copy_sendfile))
+kCopyMethods.append(('userspace', _copy_userspace))
+
+def _copy(src, dst, methods=None):
+  """Copy src to dst with the first of the given copy methods that works.
+  Returns the name of the method used."""
+  if methods is None:
+    methods = kCopyMethods
+  src_fd = os.open(src, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+  try:
+    st = os.fstat(src_fd)
+    for name, method in methods:
+      if (st.st_dev, name) in gUnsupported:
+        continue
+      dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o600)
+      try:
+        try:
+          method(src_fd, dst_fd, st.st_size)
+          return name
+        except (OSError, IOError, ImportError) as exc:
+          if name == 'userspace' or (not isinstance(exc, ImportError)
+                                     and exc.errno not in kUnsupportedErrors):
+            raise
+          gUnsupported.add((st.st_dev, name))
+          os.lseek(src_fd, 0, os.SEEK_SET)
+      finally:
+        os.close(dst_fd)
+  finally:
+    os.close(src_fd)
+
+def _same_content_stat(st, bak_filename, bak_st=None):
+  """Check if bak_filename has the size and modification time in stat result
+  st"""
+  if bak_st is None:
+    try:
+      bak_st = os.stat(bak_filename)
+    except OSError:
+      return False
+  return (bak_st.st_size == st.st_size
+          and getattr(st, 'st_mtime_ns', st.st_mtime) == getattr(bak_st, 'st_mtime_ns', bak_st.st_mtime))
+
+def _same_content(filename, st, bak_filename):
+  """Check if bak_filename has the same content as filename, whose stat
+  result is st.  A *.bak with the same size and modification time is assumed
+  to be the same.  Otherwise the files are compared and an identical *.bak
+  gets the file's modification time so the next check is quick."""
+  try:
+    bak_st = os.stat(bak_filename)
+  except OSError:
+    return False
+  if bak_st.st_size != st.st_size:
+    return False
+  if _same_content_stat(st, bak_filename, bak_st):
+    return True
+  f1 = open(filename, 'rb')
+  try:
+    f2 = open(bak_filename, 'rb')
+    try:
+      while True:
+        data = f1.read(kCopyChunkSize)
+        if data != f2.read(kCopyChunkSize):
+          return False
+        if not data:
+          break
+    finally:
+      f2.close()
+  finally:
+    f1.close()
+  shutil.copystat(filename, bak_filename)
+  return True
+
+def _replace(src, dst):
+  if hasattr(os, 'replace'):
+    os.replace(src, dst)
+  else:
+    if os.name == 'nt' and os.path.exists(dst):
+      os.remove(dst)
+    os.rename(src, dst)
+
+def _make_bak(filename, bak_filename):
+  """Copy filename to bak_filename unless the *.bak already has the same
+  content"""
+  try:
+    st = os.stat(filename)
+  except OSError:
+    return  # New file
+  if _same_content(filename, st, bak_filename):
+    return
+  tmp_filename = bak_filename + '.tmp'
+  if os.path.exists(tmp_filename):
+    os.remove(tmp_filename)
+  if kUseHardlink:
+    try:
+      os.link(filename, tmp_filename)
+      _replace(tmp_filename, bak_filename)
+      return
+    except OSError:
+      pass
+  _copy(filename, tmp_filename)
+  shutil.copystat(filename, tmp_filename)
+  _replace(tmp_filename, bak_filename)
+
+# Delta encoding of large files in the backup store, in the style of rsync:
+# the previous version is described by a signature with a weak (adler32) and a
+# strong (md5) checksum of each block.  The new version is matched against it
+# block by block, and where blocks don't line up a rolling adler32 finds the
+# next matching block, so the work done in Python scales with the size of the
+# changes.  A delta is a gzipped "<base hash> <depth>" line followed by
+# records: b'C' + first block + block count, or b'L' + length + literal bytes.
+
+_kAdlerMod = 65521
+_kCopyRecord = struct.Struct('>cQQ')
+_kLiteralRecord = struct.Struct('>cQ')
+_kSignatureRecord = struct.Struct('>I16s')
+
+def _block_signature(data):
+  """Return [(adler32, md5 digest)] for the full blocks in data, which must
+  start at a block boundary"""
+  blocks = []
+  for start in range(0, len(data) - kDeltaBlockSize + 1, kDeltaBlockSize):
+    block = data[start:start + kDeltaBlockSize]
+    blocks.append((zlib.adler32(block) & 0xffffffff, hashlib.md5(block).digest()))
+  return blocks
+
+def _write_signature(filename, signature):
+  tmp_filename = filename + '.tmp'
+  f = open(tmp_filename, 'wb')
+  try:
+    f.write(struct.pack('>I', kDeltaBlockSize))
+    for weak, strong in signature:
+      f.write(_kSignatureRecord.pack(weak, strong))
+  finally:
+    f.close()
+  _replace(tmp_filename, filename)
+  return os.path.getsize(filename)
+
+def _load_signature(filename):
+  """Return {adler32: {md5 digest: block number}} for a signature file, or
+  None if it was made with another block size"""
+  f = open(filename, 'rb')
+  try:
+    data = f.read()
+  finally:
+    f.close()
+  if struct.unpack('>I', data[:4])[0] != kDeltaBlockSize:
+    return None
+  weak_map = {}
+  rec_size = _kSignatureRecord.size
+  for i in range((len(data) - 4) // rec_size):
+    weak, strong = _kSignatureRecord.unpack_from(data, 4 + i * rec_size)
+    weak_map.setdefault(weak, {}).setdefault(strong, i)
+  return weak_map
+
+def _write_delta_ops(f, size, weak_map, out, max_literal):
+  """Write the delta records for the content of open file f against the
+  signature weak_map to out.  Returns False if more than max_literal bytes
+  did not match, in which case the delta is incomplete.  Without a
+  signature (e.g. the block size changed) there is nothing to match."""
+  if weak_map is None:
+    return False
+  B = kDeltaBlockSize
+  if size == 0:
+    data = b''
+    m = None
+  else:
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    data = m
+  if sys.version_info[0] >= 3:
+    byte = data.__getitem__
+  else:
+    byte = lambda i: ord(data[i])
+  literal = [0]
+  copy = [None, 0]  # pending run of copied blocks
+  def flush_copy():
+    if copy[0] is not None:
+      out.write(_kCopyRecord.pack(b'C', copy[0], copy[1]))
+      copy[0] = None
+  def add_copy(block):
+    if copy[0] is not None and copy[0] + copy[1] == block:
+      copy[1] += 1
+    else:
+      flush_copy()
+      copy[0], copy[1] = block, 1
+  def add_literal(start, end):
+    if end > start:
+      flush_copy()
+      out.write(_kLiteralRecord.pack(b'L', end - start))
+      out.write(data[start:end])
+      literal[0] += end - start
+  def match(weak, start):
+    strongs = weak_map.get(weak)
+    if strongs is None:
+      return None
+    return strongs.get(hashlib.md5(data[start:start + B]).digest())
+
+  try:
+    pos = 0
+    lit_start = 0
+    while pos + B <= size:
+      weak = zlib.adler32(data[pos:pos + B]) & 0xffffffff
+      block = match(weak, pos)
+      if block is None:
+        # Roll the checksum forward a byte at a time to find the next match
+        a = weak & 0xffff
+        b = weak >> 16
+        block = None
+        while pos + B < size:
+          if literal[0] + pos - lit_start > max_literal:
+            return False
+          x0 = byte(pos)
+          a = (a - x0 + byte(pos + B)) % _kAdlerMod
+          b = (b - B * x0 + a - 1) % _kAdlerMod
+          pos += 1
+          block = match((b << 16) | a, pos)
+          if block is not None:
+            break
+        if block is None:
+          break
+      add_literal(lit_start, pos)
+      add_copy(block)
+      pos += B
+      lit_start = pos
+    add_literal(lit_start, size)
+    flush_copy()
+  finally:
+    if m is not None:
+      m.close()
+  return literal[0] <= max_literal
+
+def _apply_delta(base, f):
+  """Rebuild content from base content and the delta records in open file f"""
+  parts = []
+  B = kDeltaBlockSize
+  while True:
+    kind = f.read(1)
+    if not kind:
+      break
+    if kind == b'C':
+      kind, first, count = _kCopyRecord.unpack(kind + f.read(_kCopyRecord.size - 1))
+      parts.append(base[first * B:(first + count) * B])
+    else:
+      kind, length = _kLiteralRecord.unpack(kind + f.read(_kLiteralRecord.size - 1))
+      parts.append(f.read(length))
+  return b''.join(parts)
+
+class _BackupStore:
+  """Content addressed store of file versions.  Content is kept gzipped in
+  objects/<hash[:2]>/<hash>.gz and index/<hash of path>.json lists the
+  versions of each file as {"time", "hash", "size"}, oldest first.
+  store.json tracks the total size of the objects and when objects no longer
+  used were last removed.  Versions of large files
+  are kept as a delta against the previous version (<hash>.delta.gz) with a
+  block signature (<hash>.sig) for computing the next delta."""
+
+  def __init__(self, dirname):
+    self.dirname = dirname
+
+  def _object_filename(self, digest):
+    return os.path.join(self.dirname, 'objects', digest[:2], digest + '.gz')
+
+  def _index_filename(self, filename):
+    key = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    return os.path.join(self.dirname, 'index', key + '.json')
+
+  def _read_json(self, filename, default):
+    try:
+      f = open(filename)
+    except IOError:
+      return default
+    try:
+      return json.load(f)
+    except ValueError:
+      return default
+    finally:
+      f.close()
+
+  def _write_json(self, filename, value):
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    tmp_filename = filename + '.tmp'
+    f = open(tmp_filename, 'w')
+    try:
+      json.dump(value, f)
+    finally:
+      f.close()
+    _replace(tmp_filename, filename)
+
+  def versions(self, filename):
+    return self._read_json(self._index_filename(filename), {'versions': []})['versions']
+
+  def _delta_filename(self, digest):
+    return os.path.join(self.dirname, 'objects', digest[:2], digest + '.delta.gz')
+
+  def _signature_filename(self, digest):
+    return os.path.join(self.dirname, 'objects', digest[:2], digest + '.sig')
+
+  def _has_object(self, digest):
+    return (os.path.exists(self._object_filename(digest))
+            or os.path.exists(self._delta_filename(digest)))
+
+  def _add_object(self, src, prev=None):
+    """Store the content of file src unless already there, as a delta against
+    the previous version prev if src is large.  Returns (hash, size, bytes
+    added to the store, delta chain depth)."""
+    f = open(src, 'rb')
+    try:
+      size = os.fstat(f.fileno()).st_size
+      large = kDeltaMinSize and size >= kDeltaMinSize
+      sha = hashlib.sha1()
+      signature = []
+      while True:
+        data = f.read(kCopyChunkSize)
+        if not data:
+          break
+        sha.update(data)
+        if large:
+          signature.extend(_block_signature(data))
+      digest = sha.hexdigest()
+      if self._has_object(digest):
+        return digest, size, 0, self._depth(digest)
+      dirname = os.path.dirname(self._object_filename(digest))
+      if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+      added = 0
+      depth = 0
+      if large:
+        added += _write_signature(self._signature_filename(digest), signature)
+        if (prev is not None and prev.get('depth', 0) + 1 < kDeltaFullEvery
+            and os.path.exists(self._signature_filename(prev['hash']))):
+          delta_size = self._write_delta(f, size, digest, prev)
+          if delta_size is not None:
+            return digest, size, added + delta_size, prev.get('depth', 0) + 1
+      obj_filename = self._object_filename(digest)
+      tmp_filename = obj_filename + '.tmp'
+      f.seek(0)
+      out = gzip.GzipFile(tmp_filename, 'wb', kCompressLevel)
+      try:
+        while True:
+          data = f.read(kCopyChunkSize)
+          if not data:
+            break
+          out.write(data)
+      finally:
+        out.close()
+      _replace(tmp_filename, obj_filename)
+    finally:
+      f.close()
+    return digest, size, added + os.path.getsize(obj_filename), depth
+
+  def _write_delta(self, f, size, digest, prev):
+    """Write the content of open file f as a delta against version prev.
+    Returns the bytes written or None if the files differ too much for a
+    delta to be worthwhile."""
+    weak_map = _load_signature(self._signature_filename(prev['hash']))
+    delta_filename = self._delta_filename(digest)
+    tmp_filename = delta_filename + '.tmp'
+    out = gzip.GzipFile(tmp_filename, 'wb', kCompressLevel)
+    try:
+      out.write(('%s %d\n' % (prev['hash'], prev.get('depth', 0) + 1)).encode('ascii'))
+      ok = _write_delta_ops(f, size, weak_map, out, size * kDeltaMaxLiteral)
+    finally:
+      out.close()
+    if not ok:
+      os.remove(tmp_filename)
+      return None
+    _replace(tmp_filename, delta_filename)
+    return os.path.getsize(delta_filename)
+
+  def _delta_header(self, digest):
+    """Return (base hash, depth) for a delta object"""
+    f = gzip.GzipFile(self._delta_filename(digest), 'rb')
+    try:
+      base, depth = f.readline().decode('ascii').split()
+    finally:
+      f.close()
+    return base, int(depth)
+
+  def _depth(self, digest):
+    if os.path.exists(self._delta_filename(digest)):
+      return self._delta_header(digest)[1]
+    return 0
+
+  def add(self, filename, src=None):
+    """Add the current content of filename (or of src, a copy of it) as a new
+    version unless it is the same as the last version"""
+    if src is None:
+      src = filename
+    if not os.path.exists(src):
+      return
+    index_filename = self._index_filename(filename)
+    index = self._read_json(index_filename, {'path': os.path.abspath(filename), 'versions': []})
+    prev = index['versions'][-1] if index['versions'] else None
+    digest, size, added, depth = self._add_object(src, prev)
+    if prev is not None and prev['hash'] == digest:
+      return
+    index['versions'].append({'time': time.time(), 'hash': digest, 'size': size, 'depth': depth})
+    removed = self._prune_versions(index['versions'])
+    self._write_json(index_filename, index)
+    stats = self._read_json(os.path.join(self.dirname, 'store.json'), {'size': 0})
+    stats['size'] += added
+    self._write_json(os.path.join(self.dirname, 'store.json'), stats)
+    # Objects of dropped versions are only removed now and then, since that
+    # means reading the whole store
+    if ((kMaxStoreSize and stats['size'] > kMaxStoreSize)
+        or (removed and time.time() - stats.get('collected', 0) > kCollectInterval)):
+      self.collect_garbage()
+
+  def _prune_versions(self, versions):
+    """Drop versions beyond the count and age limits, always keeping the
+    newest.  Returns True if any were dropped."""
+    count = len(versions)
+    if kKeepVersions and len(versions) > kKeepVersions:
+      del versions[:len(versions) - kKeepVersions]
+    if kKeepDays:
+      cutoff = time.time() - kKeepDays * 86400
+      while len(versions) > 1 and versions[0]['time'] < cutoff:
+        del versions[0]
+    return len(versions) != count
+
+  def read(self, digest):
+    if os.path.exists(self._object_filename(digest)):
+      f = gzip.GzipFile(self._object_filename(digest), 'rb')
+      try:
+        return f.read()
+      finally:
+        f.close()
+    f = gzip.GzipFile(self._delta_filename(digest), 'rb')
+    try:
+      base_digest = f.readline().decode('ascii').split()[0]
+      return _apply_delta(self.read(base_digest), f)
+    finally:
+      f.close()
+
+  def collect_garbage(self):
+    """Apply the total size limit by removing the oldest versions of any
+    file and remove objects that no version refers to any more"""
+    index_dir = os.path.join(self.dirname, 'index')
+    indexes = {}
+    for name in os.listdir(index_dir):
+      if name.endswith('.json'):
+        indexes[name] = self._read_json(os.path.join(index_dir, name), {'versions': []})
+    object_sizes = {}
+    object_files = {}
+    for dirpath, dirnames, filenames in os.walk(os.path.join(self.dirname, 'objects')):
+      for name in filenames:
+        if name.endswith(('.gz', '.sig')):
+          digest = name.split('.')[0]
+          path = os.path.join(dirpath, name)
+          object_sizes[digest] = object_sizes.get(digest, 0) + os.path.getsize(path)
+          object_files.setdefault(digest, []).append(path)
+
+    # Delta objects keep the versions they are based on
+    bases = {}
+    for digest in object_files:
+      if os.path.exists(self._delta_filename(digest)):
+        bases[digest] = self._delta_header(digest)[0]
+    def chain(digest):
+      found = []
+      while digest is not None and digest not in found:
+        found.append(digest)
+        digest = bases.get(digest)
+      return found
+
+    changed = set()
+    if kMaxStoreSize:
+      refs = {}
+      all_versions = []
+      for name, index in indexes.items():
+        for version in index['versions']:
+          for digest in chain(version['hash']):
+            refs[digest] = refs.get(digest, 0) + 1
+          all_versions.append((version['time'], name, version))
+      total = sum([object_sizes.get(digest, 0) for digest in refs])
+      all_versions.sort(key=lambda v: v[0])
+      for t, name, version in all_versions:
+        if total <= kMaxStoreSize:
+          break
+        if len(indexes[name]['versions']) == 1:
+          continue  # Always keep the newest version of a file
+        indexes[name]['versions'].remove(version)
+        changed.add(name)
+        for digest in chain(version['hash']):
+          refs[digest] -= 1
+          if refs[digest] == 0:
+            total -= object_sizes.get(digest, 0)
+
+    for name in changed:
+      self._write_json(os.path.join(index_dir, name), indexes[name])
+    used = set()
+    for index in indexes.values():
+      for version in index['versions']:
+        used.update(chain(version['hash']))
+    for digest in list(object_files):
+      if digest not in used:
+        for path in object_files[digest]:
+          os.remove(path)
+        del object_sizes[digest]
+    self._write_json(os.path.join(self.dirname, 'store.json'),
+                     {'size': sum(object_sizes.values()), 'collected': time.time()})
+
+gStore = None
+
+def _get_store():
+  global gStore
+  if gStore is None:
+    dirname = kBackupDir
+    if dirname is None:
+      dirname = os.path.join(wingapi.gApplication.GetUserSettingsDir(), 'backups')
+    gStore = _BackupStore(dirname)
+  return gStore
+
+# Backups made on a background thread.  Before a save goes ahead the old file
+# is captured as a snapshot next to it (a reflink or, with kUseHardlink, a
+# hard link when possible, which take microseconds; otherwise a kernel copy)
+# and the snapshot is recorded in a queue file.  A single worker thread then
+# compares, compresses and stores the snapshots in the order the saves were
+# made.  Snapshots still queued when Wing exits are backed up the next time
+# the script is loaded.
+
+gBackupQueue = None  # _BackupQueue, created on first use
+
+def _snapshot(filename):
+  """Capture the current content of filename in a new file next to it.
+  Returns the snapshot's filename or None if filename does not exist."""
+  try:
+    st = os.stat(filename)
+  except OSError:
+    return None
+  snapshot = '%s.bak-%d-%d.tmp' % (filename, os.getpid(), int(time.time() * 1000000))
+  linked = False
+  if kUseHardlink and (st.st_dev, 'reflink') in gUnsupported:
+    try:
+      os.link(filename, snapshot)
+      linked = True
+    except OSError:
+      pass
+  if not linked:
+    _copy(filename, snapshot)
+    shutil.copystat(filename, snapshot)
+  # The queue file will say the snapshot exists and the save then replaces
+  # the original, so it must be on disk first
+  fd = os.open(snapshot, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+  if hasattr(os, 'O_DIRECTORY'):
+    fd = os.open(os.path.dirname(os.path.abspath(snapshot)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+  return snapshot
+
+class _BackupQueue(threading.Thread):
+  """Backs up the (filename, snapshot) jobs queued by the main
+  thread one at a time in the order they were queued.  Jobs not yet done are
+  listed in a JSON file so they survive a restart; failures are queued back
+  and reported on the main thread by _report_backup_errors()."""
+
+  def __init__(self, queue_filename):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.queue_filename = queue_filename
+    self.jobs = queue.Queue()
+    self.errors = queue.Queue()
+    self.lock = threading.Lock()
+    self.pending = []
+    try:
+      f = open(queue_filename)
+      try:
+        pending = json.load(f)
+      finally:
+        f.close()
+    except (IOError, OSError, ValueError):
+      pending = []
+    for job in pending:
+      if os.path.exists(job[1]):
+        self.put(*job)
+
+  def _write_pending(self):
+    tmp_filename = self.queue_filename + '.tmp'
+    f = open(tmp_filename, 'w')
+    try:
+      json.dump(self.pending, f)
+      f.flush()
+      os.fsync(f.fileno())
+    finally:
+      f.close()
+    _replace(tmp_filename, self.queue_filename)
+
+  def put(self, filename, snapshot):
+    job = [filename, snapshot]
+    with self.lock:
+      self.pending.append(job)
+      self._write_pending()
+    self.jobs.put(job)
+
+  def run(self):
+    while True:
+      job = self.jobs.get()
+      filename, snapshot = job
+      try:
+        if kBackupMode == 'store':
+          _get_store().add(filename, snapshot)
+          os.remove(snapshot)
+        else:
+          _finish_bak(snapshot, filename + '.bak')
+      except Exception as exc:
+        self.errors.put((filename, exc))
+        try:
+          if os.path.exists(snapshot):
+            os.remove(snapshot)
+        except OSError:
+          pass
+      with self.lock:
+        self.pending.remove(job)
+        self._write_pending()
+
+def _finish_bak(snapshot, bak_filename):
+  """Make snapshot the *.bak file unless that already has the same content"""
+  if _same_content(snapshot, os.stat(snapshot), bak_filename):
+    os.remove(snapshot)
+    return
+  fd = os.open(snapshot, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+  _replace(snapshot, bak_filename)
+
+def _report_backup_errors():
+  errors = []
+  while True:
+    try:
+      errors.append('%s: %s' % gBackupQueue.errors.get_nowait())
+    except queue.Empty:
+      break
+  if errors:
+    wingapi.gApplication.ShowMessageDialog("Backup Failed", '\n'.join(errors))
+  return True
+
+def _backup_queue_filename():
+  return os.path.join(wingapi.gApplication.GetUserSettingsDir(), 'autosavebak-queue.json')
+
+def _get_backup_queue():
+  global gBackupQueue
+  if gBackupQueue is None:
+    if kBackupMode == 'store':
+      # Find the store on the main thread; the worker can't call wingapi
+      _get_store()
+    gBackupQueue = _BackupQueue(_backup_queue_filename())
+    gBackupQueue.start()
+    wingapi.gApplication.InstallTimeout(1000, _report_backup_errors)
+  return gBackupQueue
+
+def _backup_async(filename):
+  try:
+    st = os.stat(filename)
+  except OSError:
+    return  # New file
+  if kBackupMode != 'store' and _same_content_stat(st, filename + '.bak'):
+    return
+  snapshot = _snapshot(filename)
+  if snapshot is not None:
+    _get_backup_queue().put(filename, snapshot)
+
+def _backup(filename):
+  if kAsyncBackup:
+    _backup_async(filename)
+  elif kBackupMode == 'store':
+    _get_store().add(filename)
+  else:
+    _make_bak(filename, filename + '.bak')
+
 def _connect_to_presave(doc):
   def _on_presave(filename, encoding):
     # Avoid operation when saving a copy to another location
     if filename is not None:
       return
-    # Write *.bak file
-    f = open(doc.GetFilename(), 'r')
-    txt = f.read()
-    f.close()
-    bak_filename = doc.GetFilename() + '.bak'
-    f = open(bak_filename, 'w')
-    f.write(txt)
-    f.close()
+    _backup(doc.GetFilename())
   doc.Connect('presave', _on_presave)
-  
+
+def list_backups():
+  """List the versions of the current editor's file in the backup store"""
+  app = wingapi.gApplication
+  editor = app.GetActiveEditor()
+  if editor is None:
+    return
+  filename = editor.GetDocument().GetFilename()
+  versions = _get_store().versions(filename)
+  if not versions:
+    app.ShowMessageDialog("Backups", "No backups of %s" % filename)
+    return
+  lines = ["Backups of %s (restore with restore-backup):" % filename, '']
+  for i, version in enumerate(reversed(versions)):
+    lines.append("%3d  %s  %10d bytes" % (i + 1, time.strftime('%Y-%m-%d %H:%M:%S',
+                                                              time.localtime(version['time'])),
+                                          version['size']))
+  app.ShowMessageDialog("Backups", '\n'.join(lines))
+
+list_backups.label = "List Backups"
+
+def restore_backup(version):
+  """Replace the text in the current editor with a version from the backup
+  store, where 1 is the most recent one shown by list-backups.  The file is
+  not saved, so this can be undone."""
+  app = wingapi.gApplication
+  editor = app.GetActiveEditor()
+  if editor is None:
+    return
+  doc = editor.GetDocument()
+  versions = _get_store().versions(doc.GetFilename())
+  try:
+    n = int(version)
+  except ValueError:
+    n = 0
+  if not 1 <= n <= len(versions):
+    app.ShowMessageDialog("Restore Backup", "No backup version %s" % version)
+    return
+  version = versions[-n]
+  data = _get_store().read(version['hash'])
+  try:
+    txt = data.decode('utf-8')
+  except UnicodeDecodeError:
+    txt = data.decode('latin-1')
+  doc.BeginUndoAction()
+  try:
+    doc.SetText(txt)
+  finally:
+    doc.EndUndoAction()
+
+restore_backup.label = "Restore Backup"
+
+def benchmark_bak_copy():
+  """Time each way of making *.bak files, and the old text mode read and
+  write, on large files in the temporary directory"""
+  tmpdir = tempfile.mkdtemp()
+  lines = ['Copying in %s:' % tmpdir, '']
+  try:
+    for size in kBenchmarkSizes:
+      src = os.path.join(tmpdir, 'src')
+      f = open(src, 'wb')
+      try:
+        block = os.urandom(1 << 20)
+        for i in range(size):
+          f.write(block)
+      finally:
+        f.close()
+      dst = os.path.join(tmpdir, 'dst')
+      for name, method in kCopyMethods:
+        gUnsupported.clear()
+        start = time.time()
+        try:
+          _copy(src, dst, [(name, method)])
+        except Exception as exc:
+          lines.append('%5d MB  %-20s failed: %s' % (size, name, exc))
+          continue
+        lines.append('%5d MB  %-20s %8.1f ms' % (size, name, (time.time() - start) * 1000))
+      start = time.time()
+      f = open(src, 'r', errors='replace') if sys.version_info[0] >= 3 else open(src, 'r')
+      txt = f.read()
+      f.close()
+      f = open(dst, 'w')
+      f.write(txt)
+      f.close()
+      lines.append('%5d MB  %-20s %8.1f ms' % (size, 'text read/write', (time.time() - start) * 1000))
+      _copy(src, dst)
+      start = time.time()
+      _make_bak(src, dst)
+      lines.append('%5d MB  %-20s %8.1f ms' % (size, 'unchanged, compared', (time.time() - start) * 1000))
+      start = time.time()
+      _make_bak(src, dst)
+      lines.append('%5d MB  %-20s %8.1f ms' % (size, 'unchanged, stat', (time.time() - start) * 1000))
+      lines.append('')
+  finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
+  wingapi.gApplication.ShowMessageDialog("Backup Copy Benchmark", '\n'.join(lines))
+
+benchmark_bak_copy.label = "Benchmark Backup Copying"
+
 def _init_bak():
+  # Back up snapshots left over from the last session
+  if os.path.exists(_backup_queue_filename()):
+    _get_backup_queue()
   wingapi.gApplication.Connect('document-open', _connect_to_presave)
   for doc in wingapi.gApplication.GetOpenDocuments():
     _connect_to_presave(doc)
 
 _init_bak()
-
@@ -1,12 +1,38 @@
 # Written by Philip Winston
 #
-# Adds command 'header-flip' that toggles between a C/C++ file and the 
-# matching header file. Requires the source and header file are in the 
-# same directory right now, but could be extended to search the whole project.
+# Adds command 'header-flip' that toggles between a C/C++ file and the
+# matching header file. The match is looked up in an index of the project's
+# files by name, so the header may be in another directory (e.g. include/);
+# the candidate closest to the file's directory wins. Files that are not in
+# the project are matched in the same directory only.
+#
+# Also adds commands 'goto-includers' and 'goto-included' that go to the
+# files that #include the current file or that it includes.
+#
+# With PREFETCH_COUNTERPART (off by default) the counterpart of each C/C++
+# file that is opened is looked up and read in the background ahead of
+# header-flip.
 
 import os
+import re
+import json
+import shlex
+import threading
+import collections
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import wingapi
 
+C_EXTS = ['.c', '.cxx', '.cpp', '.c++', '.cc']
+H_EXTS = ['.h', '.hpp']
+
+# Pairs of extension lists that flip to each other, in order of preference
+EXT_FAMILIES = [
+    (C_EXTS, H_EXTS),
+]
+
 def findMatchingFile(basepath, exts):
     """Return the first file which exists with one of the given extensions."""
     for ext in exts:
@@ -15,40 +41,505 @@ def findMatchingFile(basepath, exts):
             return path
     return None
 
+def _otherExts(ext):
+    """Return the extensions a file with extension ext flips to."""
+    ext = ext.lower()
+    for exts1, exts2 in EXT_FAMILIES:
+        if ext in exts1:
+            return exts2
+        if ext in exts2:
+            return exts1
+    return None
+
+def _dirDistance(path1, path2):
+    """Return the number of directories between the directories of two
+    files."""
+    dirparts1 = os.path.normcase(os.path.dirname(path1)).split(os.sep)
+    dirparts2 = os.path.normcase(os.path.dirname(path2)).split(os.sep)
+    common = 0
+    for part1, part2 in zip(dirparts1, dirparts2):
+        if part1 != part2:
+            break
+        common += 1
+    return len(dirparts1) + len(dirparts2) - 2 * common
+
+def _isSourceFile(path):
+    return _otherExts(os.path.splitext(path)[1]) is not None
+
+class _PairIndex:
+    """Index of the project's files by name without extension, kept up to
+    date as files are added to and removed from the project."""
+
+    def __init__(self):
+        self.byStem = {}
+        self.project = None
+        self.signals = []
+
+    def _key(self, path):
+        stem, ext = os.path.splitext(os.path.basename(path))
+        if _otherExts(ext) is None:
+            return None
+        return os.path.normcase(stem)
+
+    def add(self, paths):
+        for path in paths:
+            key = self._key(path)
+            if key is not None:
+                self.byStem.setdefault(key, set()).add(path)
+
+    def remove(self, paths):
+        for path in paths:
+            key = self._key(path)
+            if key in self.byStem:
+                self.byStem[key].discard(path)
+                if not self.byStem[key]:
+                    del self.byStem[key]
+
+    def update(self):
+        """Rebuild the index if the project has changed since it was built."""
+        project = wingapi.gApplication.GetProject()
+        if project is None:
+            return
+        if project.GetFilename() == self.project:
+            return
+        for obj, signal in self.signals:
+            obj.Disconnect(signal)
+        self.byStem = {}
+        self.project = project.GetFilename()
+        self.signals = []
+        self.add(project.GetAllFiles())
+        self.signals.append((project, project.Connect('files-added', self.add)))
+        self.signals.append((project, project.Connect('files-removed', self.remove)))
+
+    def lookup(self, path):
+        """Return the candidates to flip to from path, best first."""
+        stem, ext = os.path.splitext(os.path.basename(path))
+        exts = _otherExts(ext)
+        if exts is None:
+            return []
+        def rank(candidate):
+            return (_dirDistance(path, candidate),
+                    exts.index(os.path.splitext(candidate)[1].lower()), candidate)
+        candidates = [c for c in self.byStem.get(os.path.normcase(stem), ())
+                      if os.path.splitext(c)[1].lower() in exts]
+        return sorted(candidates, key=rank)
+
+_gIndex = _PairIndex()
+
+def _findCounterpart(filename):
+    """Return the file to flip to from filename, or None."""
+    _gIndex.update()
+    candidates = _gIndex.lookup(filename)
+    if candidates:
+        return candidates[0]
+    prefetched, alt = _gPrefetcher.get(filename)
+    if prefetched and alt is not None and os.path.exists(alt):
+        return alt
+    exts = _otherExts(os.path.splitext(filename)[1])
+    if exts is None:
+        return None
+    return findMatchingFile(os.path.splitext(filename)[0], exts)
+
+# Prefetching of counterparts.  When a C/C++ file is opened its counterpart
+# is looked up and read on a background thread, so that header-flip later
+# finds it already resolved and in the OS (or NFS client) cache.  The
+# scripting API cannot load a document without showing it in an editor, so
+# the file is only warmed in the OS cache rather than kept open as a hidden
+# document; the flip still pays for Wing's lexing and analysis of it.  The
+# last PREFETCH_LIMIT lookups are remembered.  This reads each counterpart in
+# full, which costs network traffic on NFS, so it is off by default.
+
+PREFETCH_COUNTERPART = False
+PREFETCH_LIMIT = 20
+
+class _Prefetcher(threading.Thread):
+    """Resolves and reads the counterparts of the files queued by the main
+    thread.  counterparts maps a file to its counterpart, or None if it has
+    none, in least recently used order.  Errors are reported like those of
+    the include graph."""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.jobs = queue.Queue()
+        self.errors = queue.Queue()
+        self.lock = threading.Lock()
+        self.counterparts = collections.OrderedDict()
+
+    def get(self, filename):
+        """Return (True, counterpart) if filename was prefetched, otherwise
+        (False, None)."""
+        with self.lock:
+            if filename not in self.counterparts:
+                return False, None
+            alt = self.counterparts.pop(filename)
+            self.counterparts[filename] = alt
+            return True, alt
+
+    def run(self):
+        while True:
+            filename, candidates = self.jobs.get()
+            try:
+                self._prefetch(filename, candidates)
+            except Exception as e:
+                self.errors.put((filename, str(e)))
+
+    def _prefetch(self, filename, candidates):
+        if candidates:
+            alt = candidates[0]
+        else:
+            exts = _otherExts(os.path.splitext(filename)[1])
+            alt = findMatchingFile(os.path.splitext(filename)[0], exts)
+        with self.lock:
+            self.counterparts.pop(filename, None)
+            self.counterparts[filename] = alt
+            while len(self.counterparts) > PREFETCH_LIMIT:
+                self.counterparts.popitem(last=False)
+        if alt is not None:
+            f = open(alt, 'rb')
+            try:
+                while f.read(1 << 20):
+                    pass
+            finally:
+                f.close()
+
+_gPrefetcher = _Prefetcher()
+
+def _prefetchCounterpart(doc):
+    filename = doc.GetFilename()
+    if not PREFETCH_COUNTERPART or not _isSourceFile(filename):
+        return
+    # The index is only used on this thread; the lookup is cheap
+    _gIndex.update()
+    _gPrefetcher.jobs.put((filename, _gIndex.lookup(filename)))
+
 def header_flip():
-    """Flip between the matching header and source files.
-    
-    NOTE: We assume both are in the same directory. A more advanced 
-    version might look throughout the project for a match.
+    """Flip between the matching header and source files, looking for the
+    match in the project's files closest to the current file first and in
+    the same directory otherwise.
     """
-    
-    C_EXTS = ['.c', '.cxx', '.cpp', '.c++', '.cc']
-    H_EXTS = ['.h', '.hpp']
-    
-    app = wingapi.gApplication    
+
+    app = wingapi.gApplication
     editor = app.GetActiveEditor()
     if editor is None:
         return None
     context = editor.GetSourceScope()
     if len(context) == 0:
         return None
-        
-    dirname, filename = os.path.split(context[0])
-    basename, ext = os.path.splitext(filename)
-    basepath = os.path.join(dirname, basename)
-    
-    alt = None
-    
-    if ext.lower() in C_EXTS:
-        alt = findMatchingFile(basepath, H_EXTS)
-    elif ext.lower() in H_EXTS:
-        alt = findMatchingFile(basepath, C_EXTS)
-        
+
+    filename = os.path.basename(context[0])
+    alt = _findCounterpart(context[0])
+
     if alt:
         app.OpenEditor(alt)
     else:
         msg = "Cannot flip %s" % filename
         app.ShowMessageDialog("header_flip error", msg)
-    
-        
-        
+
+# Include graph used by goto-includers and goto-included. It is built on a
+# background thread from the project's C/C++ files and updated when files
+# are saved, added or removed. #include names are resolved relative to the
+# including file, then against the include paths in compile_commands.json
+# (COMPILE_COMMANDS, or the project directory or its build/ subdirectory),
+# and finally against any project file whose path ends with the name.
+
+COMPILE_COMMANDS = None
+
+_INCLUDE_RE = re.compile(r'^[ \t]*#[ \t]*include[ \t]*[<"]([^>"\n]+)[>"]', re.MULTILINE)
+
+def _readIncludePaths(filename):
+    """Read compile_commands.json and return ({source file: [include dirs]},
+    [all include dirs])."""
+    try:
+        f = open(filename)
+        try:
+            entries = json.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        return {}, []
+    byFile = {}
+    allDirs = []
+    for entry in entries:
+        directory = entry.get('directory', '')
+        args = entry.get('arguments')
+        if args is None:
+            args = shlex.split(entry.get('command', ''))
+        dirs = []
+        for i, arg in enumerate(args):
+            for opt in ('-I', '-isystem', '-iquote'):
+                if arg == opt and i + 1 < len(args):
+                    dirs.append(args[i + 1])
+                elif arg.startswith(opt) and len(arg) > len(opt):
+                    dirs.append(arg[len(opt):])
+        dirs = [os.path.normpath(os.path.join(directory, d)) for d in dirs]
+        byFile[os.path.normpath(os.path.join(directory, entry.get('file', '')))] = dirs
+        for d in dirs:
+            if d not in allDirs:
+                allDirs.append(d)
+    return byFile, allDirs
+
+class _IncludeGraph(threading.Thread):
+    """Which files each project file includes and is included by.  Jobs are
+    ('rebuild', files, compile_commands), ('update', filename) and
+    ('remove', filename).  Errors are put on errors as (job, message) and
+    reported on the main thread by _reportErrors().  Only the worker thread
+    changes files, byName and unresolved, so it reads them without the lock,
+    which guards what lookup() reads."""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.jobs = queue.Queue()
+        self.errors = queue.Queue()
+        self.lock = threading.Lock()
+        self.project = None
+        self.signals = []
+        self.ready = False
+        self.files = set()
+        self.byName = {}
+        self.includeDirs = {}
+        self.allIncludeDirs = []
+        self.includes = {}
+        self.includers = {}
+        self.unresolved = {}  # basename -> files with an unresolved #include of it
+        self.unresolvedNames = {}  # file -> basenames it couldn't resolve
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                getattr(self, '_' + job[0])(*job[1:])
+            except Exception as e:
+                self.errors.put((job[0], str(e)))
+
+    def _rebuild(self, files, compileCommands):
+        files = [f for f in files if _isSourceFile(f)]
+        includeDirs, allIncludeDirs = {}, []
+        if compileCommands is not None:
+            includeDirs, allIncludeDirs = _readIncludePaths(compileCommands)
+        with self.lock:
+            self.ready = False
+            self.files = set()
+            self.byName = {}
+            self.includeDirs = includeDirs
+            self.allIncludeDirs = allIncludeDirs
+            self.includes = {}
+            self.includers = {}
+            self.unresolved = {}
+            self.unresolvedNames = {}
+            for filename in files:
+                self._addName(filename)
+        try:
+            for filename in files:
+                self._update(filename)
+        finally:
+            # Also after a failure, so lookups don't wait for a graph that
+            # will never be finished
+            with self.lock:
+                self.ready = True
+
+    def _addName(self, filename):
+        self.files.add(filename)
+        self.byName.setdefault(os.path.basename(filename), set()).add(filename)
+
+    def _resolve(self, filename, name, quoted):
+        """Return the file an #include of name in filename refers to."""
+        name = os.path.normpath(name)
+        dirs = self.includeDirs.get(filename, self.allIncludeDirs)
+        if quoted:
+            dirs = [os.path.dirname(filename)] + dirs
+        for d in dirs:
+            path = os.path.join(d, name)
+            if path in self.files:
+                return path
+        for d in dirs:
+            path = os.path.join(d, name)
+            if os.path.isfile(path):
+                return path
+        candidates = [p for p in self.byName.get(os.path.basename(name), ())
+                      if p.endswith(os.sep + name)]
+        if candidates:
+            return _closest(filename, candidates)
+        return None
+
+    def _update(self, filename):
+        try:
+            f = open(filename, 'rb')
+            try:
+                txt = f.read().decode('utf-8', 'replace')
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return
+        found = []
+        for match in _INCLUDE_RE.finditer(txt):
+            quoted = txt[match.start(1) - 1] == '"'
+            found.append((match.group(1), quoted))
+        if filename not in self.files and _isSourceFile(filename):
+            self._addName(filename)
+            # Files that failed to include it before may resolve to it now
+            for includer in self.unresolved.get(os.path.basename(filename), ()):
+                if includer != filename:
+                    self.jobs.put(('update', includer))
+        # Resolving may probe include directories on slow file systems, so
+        # the lock is only held to store the result
+        resolved = set()
+        unresolved = set()
+        for name, quoted in found:
+            path = self._resolve(filename, name, quoted)
+            if path is None:
+                unresolved.add(os.path.basename(name))
+            else:
+                resolved.add(path)
+        self._setUnresolved(filename, unresolved)
+        with self.lock:
+            self._setIncludes(filename, resolved)
+
+    def _remove(self, filename):
+        self._setUnresolved(filename, set())
+        self.files.discard(filename)
+        self.byName.get(os.path.basename(filename), set()).discard(filename)
+        with self.lock:
+            self._setIncludes(filename, set())
+
+    def _setUnresolved(self, filename, names):
+        for name in self.unresolvedNames.pop(filename, ()):
+            self.unresolved.get(name, set()).discard(filename)
+        if names:
+            self.unresolvedNames[filename] = names
+            for name in names:
+                self.unresolved.setdefault(name, set()).add(filename)
+
+    def _setIncludes(self, filename, resolved):
+        for path in self.includes.get(filename, ()):
+            self.includers.get(path, set()).discard(filename)
+        self.includes[filename] = resolved
+        for path in resolved:
+            self.includers.setdefault(path, set()).add(filename)
+
+    def update(self):
+        """Start a rebuild if the project has changed."""
+        project = wingapi.gApplication.GetProject()
+        if project is None or project.GetFilename() == self.project:
+            return
+        for obj, signal in self.signals:
+            obj.Disconnect(signal)
+        self.project = project.GetFilename()
+        self.signals = []
+        compileCommands = COMPILE_COMMANDS
+        if compileCommands is None and self.project and os.path.isabs(self.project):
+            projectDir = os.path.dirname(self.project)
+            for d in (projectDir, os.path.join(projectDir, 'build')):
+                if os.path.exists(os.path.join(d, 'compile_commands.json')):
+                    compileCommands = os.path.join(d, 'compile_commands.json')
+                    break
+        self.jobs.put(('rebuild', project.GetAllFiles(), compileCommands))
+        self.signals.append((project, project.Connect('files-added', self._onFilesAdded)))
+        self.signals.append((project, project.Connect('files-removed', self._onFilesRemoved)))
+
+    def _onFilesAdded(self, paths):
+        for path in paths:
+            if _isSourceFile(path):
+                self.jobs.put(('update', path))
+
+    def _onFilesRemoved(self, paths):
+        for path in paths:
+            if _isSourceFile(path):
+                self.jobs.put(('remove', path))
+
+    def lookup(self, filename, includers):
+        with self.lock:
+            if includers:
+                found = self.includers.get(filename, ())
+            else:
+                found = self.includes.get(filename, ())
+            return sorted(found), self.ready
+
+def _closest(filename, candidates):
+    """Return the candidate closest to filename's directory."""
+    return min(candidates, key=lambda c: (_dirDistance(filename, c), c))
+
+_gIncludeGraph = _IncludeGraph()
+
+def _reportErrors():
+    errors = []
+    for thread in (_gIncludeGraph, _gPrefetcher):
+        while True:
+            try:
+                errors.append('%s: %s' % thread.errors.get_nowait())
+            except queue.Empty:
+                break
+    if errors:
+        wingapi.gApplication.ShowMessageDialog("header_flip error", '\n'.join(errors))
+    return True
+
+# (current file, includers flag, files to visit) for repeated
+# goto-includers/goto-included
+_gGotoState = [None, None, []]
+
+def _gotoRelated(includers):
+    app = wingapi.gApplication
+    editor = app.GetActiveEditor()
+    if editor is None:
+        return
+    filename = editor.GetDocument().GetFilename()
+    if (_gGotoState[0] == filename and _gGotoState[1] == includers
+            and _gGotoState[2]):
+        # Repeated command: go on to the next file of the previous lookup
+        nextFile = _gGotoState[2].pop(0)
+        _gGotoState[0] = nextFile
+        app.OpenEditor(nextFile)
+        return
+    _gIncludeGraph.update()
+    found, ready = _gIncludeGraph.lookup(filename, includers)
+    if not found:
+        if includers:
+            msg = "No files include %s" % os.path.basename(filename)
+        else:
+            msg = "%s includes no project files" % os.path.basename(filename)
+        if not ready:
+            msg += " (the include graph is still being built)"
+        app.ShowMessageDialog("header_flip error", msg)
+        return
+    _gGotoState[0] = found[0]
+    _gGotoState[1] = includers
+    _gGotoState[2] = found[1:]
+    app.OpenEditor(found[0])
+
+def goto_includers():
+    """Go to a file that includes the current file.  Repeat to visit the
+    other includers in turn."""
+    _gotoRelated(True)
+
+goto_includers.label = "Go to Includers"
+
+def goto_included():
+    """Go to a file included by the current file.  Repeat to visit the
+    other included files in turn."""
+    _gotoRelated(False)
+
+goto_included.label = "Go to Included Files"
+
+def _connectToSavePoint(doc):
+    def _onSavePoint(savepoint):
+        filename = doc.GetFilename()
+        if savepoint and _isSourceFile(filename):
+            _gIncludeGraph.jobs.put(('update', filename))
+    doc.Connect('save-point', _onSavePoint)
+
+def _onDocumentOpen(doc):
+    _connectToSavePoint(doc)
+    _prefetchCounterpart(doc)
+
+def _init():
+    _gIncludeGraph.start()
+    _gIncludeGraph.update()
+    _gPrefetcher.start()
+    app = wingapi.gApplication
+    app.InstallTimeout(1000, _reportErrors)
+    app.Connect('document-open', _onDocumentOpen)
+    for doc in app.GetOpenDocuments():
+        _connectToSavePoint(doc)
+
+_init()
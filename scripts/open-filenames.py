@@ -1,10 +1,29 @@
 """These scripts allow opening the filename at the current caret position or last click
 location. For partial paths, the full path is resolved relative to the directory where the
-editor's file is located. No action is taken if the file does not exist. """
+editor's file is located. If there is no such file, the project files whose paths end with
+as much of the path as possible are offered instead, closest to the editor's file first. No
+action is taken if no file matches. Dotted Python module names such as mypkg.handlers.auth
+are looked up among the project's modules.
+
+Filenames may be quoted and may be followed by a line and column number, as in
+foo.py:12:5 or File "foo.py", line 12, in which case the file is opened at that
+line. open_all_filenames opens all the files named in the selection or on the clipboard,
+such as all the frames of a traceback.
+
+Setting _kDetectFilenames makes the filenames in the visible part of the active editor
+be found in the background ahead of time and underlined, for large log files. """
 
 # Written by Stephan Deibel
 
 import os
+import re
+import time
+import threading
+import collections
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import wingapi
 
 def open_selected_filename():
@@ -13,7 +32,7 @@ def open_selected_filename():
     editor = wingapi.gApplication.GetActiveEditor()
     start, end = editor.GetSelection()
     _open_filename_at_position(editor, start)
-    
+
 def open_clicked_filename():
     '''Open the clicked file name.  Relative paths are resolved using the
     location of the editor's file.'''
@@ -22,42 +41,738 @@ def open_clicked_filename():
         pos = editor.GetClickLocation()
     except:
         pos = editor.fEditor._FindPoint()[1]
-    _open_filename_at_position(editor, pos)    
+    _open_filename_at_position(editor, pos)
 
 open_clicked_filename.contexts = (wingapi.kContextEditor(), )
 open_clicked_filename.label = "Open Clicked Filename"
-    
-_kNonFilenameChars = ' \t\n\r()*,;\'"'
+
+def open_all_filenames():
+    '''Open every file named in the selection, or on the clipboard if
+    nothing is selected, at the line given for it.  Useful with tracebacks.
+    Relative paths are resolved using the location of the editor's file, the
+    project's directory, the project's Python path and finally the project's
+    files.'''
+    app = wingapi.gApplication
+    editor = app.GetActiveEditor()
+    dirnames = []
+    txt = ''
+    if editor is not None:
+        document = editor.GetDocument()
+        start, end = editor.GetSelection()
+        if start != end:
+            txt = document.GetCharRange(start, end)
+        dirnames.append(os.path.dirname(document.GetFilename()))
+    if not txt:
+        txt = _get_clipboard()
+    project = app.GetProject()
+    project_fn = project.GetFilename()
+    if project_fn and os.path.isabs(project_fn):
+        dirnames.append(os.path.dirname(project_fn))
+    dirnames.extend(_project_python_path(project))
+
+    # Keep the last line given for each file, which in a Python traceback is
+    # the innermost frame.  Only quoted references, as in File "..." lines,
+    # may be dotted module names; in other text they are mostly attributes.
+    refs = collections.OrderedDict()
+    dotted = set()
+    for filename, line, col, quoted in _find_all_filenames(txt, quoted=True):
+        refs[filename] = (line, col)
+        if quoted:
+            dotted.add(filename)
+    if not refs:
+        return
+
+    candidates = [(filename, _candidates_in_dirs(filename, dirnames)) for filename in refs]
+    def open_files(exists):
+        opened = set()
+        for filename, paths in candidates:
+            found = ([p for p in paths if exists[p]] or [None])[0]
+            if found is None and dirnames:
+                found = (_find_in_project(filename, dirnames[0], filename in dotted)
+                         or [None])[0]
+            if found is not None and found not in opened:
+                opened.add(found)
+                _open_file(found, *refs[filename])
+    _gExistsChecker.check(set(sum([paths for fn, paths in candidates], [])), open_files)
+
+open_all_filenames.contexts = (wingapi.kContextEditor(), )
+open_all_filenames.label = "Open All Filenames"
+
+# Maximum number of characters looked at on each side of the position
+_kMaxFilenameLen = 1000
+
+# A quoted filename, optionally followed by a line number as in Python tracebacks.
+# Quotes next to a word character are apostrophes, as in it's, and don't delimit one
+_kQuotedRE = re.compile(r'''(?<!\w)(["'])([^"'\n]+)\1(?!\w)(?:,\s*line\s+(\d+))?''')
+
+# An unquoted filename, optionally followed by :line or :line:col
+_kUnquotedRE = re.compile(r'''[^\s()*,;'"<>]+''')
+_kLineColRE = re.compile(r'^(.+?)(?::(\d+))?(?::(\d+))?:?$')
+
+def _find_filename(txt, offset):
+    """Find the filename at offset in txt.  Returns (filename, line, col),
+    where line and col are None if not given, or None if there is no
+    filename there.  This only looks at txt, so may be called from any
+    thread."""
+    start = txt.rfind('\n', 0, offset) + 1
+    end = txt.find('\n', offset)
+    if end == -1:
+        end = len(txt)
+    line_txt = txt[start:end]
+    offset -= start
+
+    for match in _kQuotedRE.finditer(line_txt):
+        if match.start() <= offset <= match.end():
+            if match.group(3):
+                return match.group(2), int(match.group(3)), None
+            filename, line, col = _kLineColRE.match(match.group(2)).groups()
+            return filename, line and int(line), col and int(col)
+    for match in _kUnquotedRE.finditer(line_txt):
+        if match.start() <= offset <= match.end():
+            filename, line, col = _kLineColRE.match(match.group()).groups()
+            return filename, line and int(line), col and int(col)
+    return None
+
+# Something that looks like a filename when found among other text
+_kLikelyFilenameRE = re.compile(r'[/\\]|\.\w+$')
+
+def _find_all_filenames(txt, spans=False, quoted=False):
+    """Find all the filenames in txt.  Returns a list of (filename, line,
+    col) like _find_filename(), with the start and end offset of each
+    reference within its line added if spans is true and whether it was
+    quoted added after that if quoted is true."""
+    found = []
+    def add(filename, line, col, span, is_quoted):
+        ref = (filename, line and int(line), col and int(col))
+        if spans:
+            ref += span
+        if quoted:
+            ref += (is_quoted,)
+        found.append(ref)
+    for line_txt in txt.splitlines():
+        quoted_spans = []
+        for match in _kQuotedRE.finditer(line_txt):
+            quoted_spans.append(match.span())
+            filename, line, col = _kLineColRE.match(match.group(2)).groups()
+            if match.group(3):
+                line, col = match.group(3), None
+            if _kLikelyFilenameRE.search(filename):
+                add(filename, line, col, match.span(), True)
+        for match in _kUnquotedRE.finditer(line_txt):
+            if [q for q in quoted_spans if q[0] <= match.start() < q[1]]:
+                continue
+            filename, line, col = _kLineColRE.match(match.group()).groups()
+            if _kLikelyFilenameRE.search(filename) and '://' not in filename:
+                add(filename, line, col, match.span(), False)
+    return found
+
+def _candidates_in_dirs(filename, dirnames):
+    """Return the paths filename may refer to relative to each of dirnames"""
+    if os.path.isabs(os.path.expanduser(filename)) or not dirnames:
+        return [_resolve_filename(filename, '')]
+    return [_resolve_filename(filename, dirname) for dirname in dirnames]
+
+# Existence checks.  os.path.exists can hang for a long time on a stale
+# network mount, so checks are made by worker threads (one set per mount) and
+# the results are delivered to a callback on the main thread.  A check that
+# takes longer than _kExistsTimeout counts as a missing file.  Results are
+# cached, for longer on network file systems, and _kMountCacheTimes can set
+# the times for particular mount points.
+
+_kExistsTimeout = 2.0  # seconds
+_kThreadsPerMount = 4
+_kLocalCacheTimes = (30.0, 2.0)  # seconds that (existing, missing) results are kept
+_kNetworkCacheTimes = (300.0, 30.0)
+_kMountCacheTimes = {}  # mount point -> (existing, missing) seconds
+_kNetworkFileSystems = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'fuse.sshfs', '9p')
+
+def _read_mounts():
+    """Return [(mount point, file system type)], longest mount point first"""
+    mounts = []
+    try:
+        f = open('/proc/mounts')
+        try:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 3:
+                    mounts.append((parts[1].replace('\\040', ' '), parts[2]))
+        finally:
+            f.close()
+    except (IOError, OSError):
+        pass
+    mounts.sort(key=lambda m: -len(m[0]))
+    return mounts
+
+class _ExistsChecker:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = {}  # filename -> (time checked, exists)
+        self.checking = set()
+        self.queues = {}  # mount point -> queue of filenames to check
+        self.requests = []  # [deadline, filenames, callback]
+        self.mounts = None
+        self.polling = False
+
+    def _mount(self, filename):
+        """Return (mount point, (existing, missing) cache times) for filename"""
+        if self.mounts is None:
+            self.mounts = _read_mounts()
+        for mount, fstype in self.mounts:
+            if filename == mount or filename.startswith(mount.rstrip(os.sep) + os.sep):
+                break
+        else:
+            mount, fstype = os.path.splitdrive(filename)[0], ''
+        if mount in _kMountCacheTimes:
+            return mount, _kMountCacheTimes[mount]
+        if fstype in _kNetworkFileSystems:
+            return mount, _kNetworkCacheTimes
+        return mount, _kLocalCacheTimes
+
+    def cached(self, filename):
+        """Return whether filename exists if known, otherwise None"""
+        with self.lock:
+            cached = self.cache.get(filename)
+        if cached is None:
+            return None
+        times = self._mount(filename)[1]
+        if time.time() - cached[0] > times[0 if cached[1] else 1]:
+            return None
+        return cached[1]
+
+    def start_check(self, filename):
+        mount = self._mount(filename)[0]
+        with self.lock:
+            if filename in self.checking:
+                return
+            self.checking.add(filename)
+            jobs = self.queues.get(mount)
+            if jobs is None:
+                jobs = self.queues[mount] = queue.Queue()
+                for i in range(_kThreadsPerMount):
+                    thread = threading.Thread(target=self._work, args=(jobs,))
+                    thread.daemon = True
+                    thread.start()
+        jobs.put(filename)
+
+    def _work(self, jobs):
+        while True:
+            filename = jobs.get()
+            exists = os.path.exists(filename)
+            with self.lock:
+                self.cache[filename] = (time.time(), exists)
+                self.checking.discard(filename)
+
+    def check(self, filenames, callback):
+        """Check which of filenames exist and call callback on the main
+        thread with a dict from filename to True or False"""
+        filenames = list(filenames)
+        unknown = [fn for fn in filenames if self.cached(fn) is None]
+        for filename in unknown:
+            self.start_check(filename)
+        if not unknown:
+            callback(dict([(fn, self.cached(fn)) for fn in filenames]))
+            return
+        if not self.polling:
+            self.polling = True
+            wingapi.gApplication.InstallTimeout(20, self._poll)
+        self.requests.append((time.time() + _kExistsTimeout, filenames, callback))
+
+    def _poll(self):
+        now = time.time()
+        for request in list(self.requests):
+            deadline, filenames, callback = request
+            results = dict([(fn, self.cached(fn)) for fn in filenames])
+            if None in results.values() and now < deadline:
+                continue
+            self.requests.remove(request)
+            for filename, exists in results.items():
+                if exists is None:
+                    results[filename] = False
+            callback(results)
+        self.polling = bool(self.requests)
+        return self.polling
+
+_gExistsChecker = _ExistsChecker()
+
+def _get_clipboard():
+    """Return the text on the clipboard, or '' if it can't be read"""
+    for modname in ('PySide6.QtWidgets', 'PyQt5.QtWidgets', 'PySide2.QtWidgets', 'PyQt4.QtGui'):
+        try:
+            mod = __import__(modname, fromlist=['QApplication'])
+        except ImportError:
+            continue
+        try:
+            return mod.QApplication.clipboard().text()
+        except Exception:
+            return ''
+    return ''
+
+def _project_python_path(project):
+    """Return the directories on the Python path set in the project's
+    environment, which is the path the project's code runs with (unlike
+    sys.path, which is the IDE's own)"""
+    try:
+        env = project.GetEnvironment()
+    except Exception:
+        return []
+    pythonpath = (env or {}).get('PYTHONPATH', '')
+    return [d for d in pythonpath.split(os.pathsep) if d and os.path.isabs(d)]
+
+def _resolve_filename(filename, dirname):
+    """Make filename absolute, resolving relative paths against dirname
+    rather than the current directory"""
+    filename = os.path.expanduser(filename)
+    if not os.path.isabs(filename):
+        filename = os.path.join(dirname, filename)
+    return os.path.normpath(filename)
+
+class _SuffixIndex:
+    """Index of the project's files by their trailing path components, kept
+    up to date as files are added to and removed from the project.  Each node
+    of the tree is a dict from the next path component (going from the file
+    name towards the root) to the child node; the key None holds the files
+    whose path ends at that node."""
+
+    def __init__(self):
+        self.root = {}
+        self.project = None
+        self.signals = []
+
+    def _components(self, filename):
+        parts = os.path.normcase(os.path.normpath(filename)).replace('\\', '/').split('/')
+        parts.reverse()
+        return [p for p in parts if p and p != '.']
+
+    def add(self, filenames):
+        for filename in filenames:
+            node = self.root
+            for part in self._components(filename):
+                node = node.setdefault(part, {})
+            node.setdefault(None, set()).add(filename)
+
+    def remove(self, filenames):
+        for filename in filenames:
+            path = [self.root]
+            for part in self._components(filename):
+                node = path[-1].get(part)
+                if node is None:
+                    break
+                path.append(node)
+            else:
+                path[-1].get(None, set()).discard(filename)
+                # Prune nodes that no longer lead to any file
+                parts = self._components(filename)
+                for i in range(len(parts), 0, -1):
+                    node = path[i]
+                    if node.get(None):
+                        break
+                    node.pop(None, None)
+                    if node:
+                        break
+                    del path[i - 1][parts[i - 1]]
+
+    def update(self):
+        """Rebuild the index if the project has changed since it was built"""
+        project = wingapi.gApplication.GetProject()
+        if project is None or project.GetFilename() == self.project:
+            return
+        for obj, signal in self.signals:
+            obj.Disconnect(signal)
+        self.root = {}
+        self.project = project.GetFilename()
+        self.signals = []
+        self.add(project.GetAllFiles())
+        self.signals.append((project, project.Connect('files-added', self.add)))
+        self.signals.append((project, project.Connect('files-removed', self.remove)))
+
+    def lookup(self, filename):
+        """Return the project files whose paths end with the most trailing
+        components of filename; at least the file name itself must match"""
+        node = self.root
+        for part in self._components(filename):
+            if part == '..' or part not in node:
+                break
+            node = node[part]
+        if node is self.root:
+            return []
+        found = []
+        todo = [node]
+        while todo:
+            node = todo.pop()
+            for key, value in node.items():
+                if key is None:
+                    found.extend(value)
+                else:
+                    todo.append(value)
+        return found
+
+_gSuffixIndex = _SuffixIndex()
+
+# Maximum number of files offered when a partial path is ambiguous
+_kMaxChoices = 10
+
+# Index of Python modules by dotted name, so references like
+# mypkg.handlers.auth can be opened.  Names are worked out from the
+# project's files and the directories on the project's Python path and in
+# _kModulePath by following __init__ files up from each module; nothing is
+# imported.  The project part is updated for just the files added to or
+# removed from the project (and the files below the package of an added or
+# removed __init__ file), and the directories on the path are scanned on a
+# background thread when the project changes.  Names whose last part is a
+# common file extension, such as config.json, are taken to be file names.
+
+_kModulePath = []  # extra directories to find modules in
+_kModuleExts = ('.py', '.pyi', '.pi')  # in order of preference
+_kDottedNameRE = re.compile(r'^[A-Za-z_]\w*(\.[A-Za-z_]\w*)+$')
+_kFileExts = ('py', 'pyi', 'pi', 'pyc', 'pyw', 'pyx', 'pxd', 'c', 'h', 'cc', 'cpp',
+              'hpp', 'js', 'ts', 'java', 'json', 'toml', 'yaml', 'yml', 'ini', 'cfg',
+              'conf', 'xml', 'html', 'htm', 'css', 'csv', 'txt', 'log', 'md', 'rst',
+              'sh', 'bat', 'sql', 'wpr', 'wpu', 'zip', 'gz', 'tar')
+
+def _is_dotted_name(name):
+    """Return whether name looks like a dotted module name rather than a
+    file name"""
+    return (_kDottedNameRE.match(name) is not None
+            and name.rsplit('.', 1)[1].lower() not in _kFileExts)
+
+def _module_name(filename, filenames):
+    """Return the dotted name of the Python file filename, or None if it
+    isn't one; filenames must include the __init__ files of its packages"""
+    base, ext = os.path.splitext(filename)
+    if ext not in _kModuleExts:
+        return None
+    dirname, name = os.path.split(base)
+    parts = [] if name == '__init__' else [name]
+    while ([e for e in _kModuleExts if os.path.join(dirname, '__init__' + e) in filenames]
+           and dirname != os.path.dirname(dirname)):
+        dirname, name = os.path.split(dirname)
+        parts.insert(0, name)
+    if not parts:
+        return None
+    return '.'.join(parts)
+
+def _module_names(filenames):
+    """Return {dotted name: [filenames]} for the Python files in filenames,
+    which must include the __init__ files of their packages"""
+    filenames = set(filenames)
+    modules = {}
+    for filename in filenames:
+        name = _module_name(filename, filenames)
+        if name is not None:
+            modules.setdefault(name, []).append(filename)
+    return modules
+
+class _ModuleIndex:
+
+    def __init__(self):
+        self.project = None
+        self.signals = []
+        self.files = set()
+        self.names = {}  # project file -> dotted name
+        self.modules = {}  # dotted name -> [project files]
+        self.path = None  # directories the path modules were found in
+        self.path_modules = {}  # from the Python path and _kModulePath
+
+    def _scan_path(self, path):
+        filenames = []
+        for dirname in path:
+            for dirpath, dirnames, names in os.walk(dirname):
+                # Only the path entry itself and packages below it hold
+                # importable modules
+                if dirpath != dirname and not [e for e in _kModuleExts if '__init__' + e in names]:
+                    dirnames[:] = []
+                    continue
+                filenames.extend([os.path.join(dirpath, n) for n in names
+                                  if os.path.splitext(n)[1] in _kModuleExts])
+        modules = _module_names(filenames)
+        # Drop the results if the project changed during the scan
+        if path == self.path:
+            self.path_modules = modules
+
+    def _add_module(self, filename):
+        name = _module_name(filename, self.files)
+        if name is not None:
+            self.names[filename] = name
+            self.modules.setdefault(name, []).append(filename)
+
+    def _remove_module(self, filename):
+        name = self.names.pop(filename, None)
+        if name is not None:
+            self.modules[name].remove(filename)
+            if not self.modules[name]:
+                del self.modules[name]
+
+    def _on_files_changed(self, filenames, added):
+        filenames = [fn for fn in filenames if os.path.splitext(fn)[1] in _kModuleExts]
+        for filename in filenames:
+            if added:
+                self.files.add(filename)
+            else:
+                self.files.discard(filename)
+        changed = set(filenames)
+        for filename in filenames:
+            dirname, name = os.path.split(filename)
+            if os.path.splitext(name)[0] == '__init__':
+                # The names of all the modules in the package change
+                prefix = dirname + os.sep
+                changed.update([fn for fn in self.files if fn.startswith(prefix)])
+        for filename in changed:
+            self._remove_module(filename)
+            if filename in self.files:
+                self._add_module(filename)
+
+    def update(self):
+        project = wingapi.gApplication.GetProject()
+        if project is None or project.GetFilename() == self.project:
+            return
+        for obj, signal in self.signals:
+            obj.Disconnect(signal)
+        self.project = project.GetFilename()
+        self.files = set([fn for fn in project.GetAllFiles()
+                          if os.path.splitext(fn)[1] in _kModuleExts])
+        self.names = {}
+        self.modules = {}
+        for filename in self.files:
+            self._add_module(filename)
+        self.signals = [
+            (project, project.Connect('files-added',
+                                      lambda filenames: self._on_files_changed(filenames, True))),
+            (project, project.Connect('files-removed',
+                                      lambda filenames: self._on_files_changed(filenames, False))),
+        ]
+        path = tuple(_project_python_path(project) + list(_kModulePath))
+        if path != self.path:
+            self.path = path
+            self.path_modules = {}
+            thread = threading.Thread(target=self._scan_path, args=(path,))
+            thread.daemon = True
+            thread.start()
+
+    def lookup(self, name):
+        """Return the files for the module name, or for the longest leading
+        part of it that is a module (the rest may name a class or function)"""
+        parts = name.split('.')
+        while parts:
+            dotted = '.'.join(parts)
+            found = self.modules.get(dotted, []) + self.path_modules.get(dotted, [])
+            if found:
+                found = list(collections.OrderedDict.fromkeys(found))
+                found.sort(key=lambda fn: _kModuleExts.index(os.path.splitext(fn)[1]))
+                return found
+            parts.pop()
+        return []
+
+_gModuleIndex = _ModuleIndex()
+
+def _dir_distance(dirname, filename):
+    """Number of directories between dirname and filename's directory"""
+    parts1 = os.path.normcase(dirname).split(os.sep)
+    parts2 = os.path.normcase(os.path.dirname(filename)).split(os.sep)
+    common = 0
+    for part1, part2 in zip(parts1, parts2):
+        if part1 != part2:
+            break
+        common += 1
+    return len(parts1) + len(parts2) - 2 * common
+
+def _find_in_project(filename, dirname, dotted=True):
+    """Return the project files a partial path or, if dotted is true, a
+    dotted module name may refer to, best first"""
+    if dotted and _is_dotted_name(filename):
+        _gModuleIndex.update()
+        found = _gModuleIndex.lookup(filename)
+        if found:
+            # Keep the preferred extension first, then the closest file
+            best_ext = os.path.splitext(found[0])[1]
+            found = [fn for fn in found if fn.endswith(best_ext)]
+            found.sort(key=lambda fn: (_dir_distance(dirname, fn), fn))
+            return found
+    _gSuffixIndex.update()
+    found = _gSuffixIndex.lookup(filename)
+    found.sort(key=lambda fn: (_dir_distance(dirname, fn), len(fn), fn))
+    return found
+
+def _choose_file(filenames, line=None, col=None):
+    """Open one of filenames, asking which one if there is more than one"""
+    if len(filenames) == 1:
+        _open_file(filenames[0], line, col)
+        return
+    def opener(filename):
+        return lambda: _open_file(filename, line, col)
+    buttons = [(fn, opener(fn)) for fn in filenames[:_kMaxChoices]]
+    buttons.append(("Cancel", None))
+    wingapi.gApplication.ShowMessageDialog(
+        "Open Filename", "Several project files match. Open which one?",
+        buttons=buttons)
+
+def _open_file(filename, line=None, col=None):
+    """Open filename in an editor, at the given 1-based line and column if
+    any"""
+    editor = wingapi.gApplication.OpenEditor(filename)
+    if editor is None or line is None:
+        return
+    doc = editor.GetDocument()
+    try:
+        pos = doc.GetLineStart(line - 1) + max((col or 1) - 1, 0)
+    except Exception:
+        return
+    editor.SetSelection(pos, pos)
+    editor.ScrollToLine(line - 1, pos='center')
 
 def _open_filename_at_position(editor, start):
-    
+
     document = editor.GetDocument()
-    startpos, endpos = None, None
-    offset = 0
-    doclen = document.GetLength()
-    while startpos is None or endpos is None:
-        if start - offset > 0 and startpos is None:
-            c1 = document.GetCharRange(start-offset-1, start-offset)
-            if c1 in _kNonFilenameChars:
-                startpos = start - offset
-        if start + offset < doclen - 1 and endpos is None:
-            c1 = document.GetCharRange(start+offset, start+offset+1)
-            if c1 in _kNonFilenameChars:
-                endpos = start + offset
-        offset += 1
-        if offset > 1000:
-            return 
-    filename = document.GetCharRange(startpos, endpos)
+    if _kDetectFilenames:
+        found = _detected_filename_at(document, start)
+        if found is not None:
+            _open_file(*found)
+            return
+
+    # Fetch the text around the position in one call and extract the
+    # filename from it
+    slice_start = max(start - _kMaxFilenameLen, 0)
+    slice_end = min(start + _kMaxFilenameLen, document.GetLength())
+    txt = document.GetCharRange(slice_start, slice_end)
+    found = _find_filename(txt, start - slice_start)
+    if found is None:
+        return
+    filename, line, col = found
+
     dirname = os.path.dirname(document.GetFilename())
-    old_dir = os.getcwd()
+    resolved = _resolve_filename(filename, dirname)
+    def open_file(exists):
+        if exists[resolved]:
+            _open_file(resolved, line, col)
+            return
+        found = _find_in_project(filename, dirname)
+        if found:
+            _choose_file(found, line, col)
+    _gExistsChecker.check([resolved], open_file)
+
+# Detection of filenames in the visible part of the active editor.  With
+# _kDetectFilenames set, the lines around the visible region are scanned on a
+# timer and the filenames found in them that exist are recorded, so
+# open-clicked-filename finds them without looking at the text or the disk
+# again.  Only lines that changed or came into view since the last scan, or
+# that name files still being checked, are scanned, and each scan stops after
+# _kDetectBudget seconds, continuing on the next tick.  The detected filenames
+# are underlined with a Scintilla indicator set through the editor's internal
+# widget (editor.fEditor), which is not part of the scripting API; if that
+# fails they are only remembered.
+
+_kDetectFilenames = False
+_kDetectInterval = 250  # ms
+_kDetectBudget = 0.01  # seconds per tick
+_kVisibleLines = 80  # lines scanned around the caret if the visible range is unknown
+_kDetectIndicator = 12  # Scintilla leaves indicators 8 and up to applications
+_kDetectIndicatorStyle = 0  # INDIC_PLAIN, a plain underline
+# document filename -> {line number: (line text, [(start col, end col,
+# resolved filename, line, col)])}
+_gDetected = {}
+_gMarkFailed = [False]
+
+def _mark_detected(editor, document, first, last, detected):
+    """Underline the filenames detected in lines first to last of editor"""
+    if _gMarkFailed[0]:
+        return
     try:
-        os.chdir(dirname)
-        filename = os.path.abspath(filename)
-        filename = os.path.expanduser(filename)
-        filename = os.path.normpath(filename)
-    finally:
-        os.chdir(old_dir)
-        
-    if os.path.exists(filename):
-        wingapi.gApplication.OpenEditor(filename)
-    
+        scint = editor.fEditor._fScint
+        scint.indic_set_style(_kDetectIndicator, _kDetectIndicatorStyle)
+        scint.set_indicator_current(_kDetectIndicator)
+        scint.indicator_clear_range(0, document.GetLength())
+        for lineno in range(first, last + 1):
+            if lineno not in detected:
+                continue
+            line_start = document.GetLineStart(lineno)
+            for ref_start, ref_end, resolved, line, col in detected[lineno][1]:
+                scint.indicator_fill_range(line_start + ref_start, ref_end - ref_start)
+    except Exception:
+        _gMarkFailed[0] = True
+
+def _visible_lines(editor, document):
+    """Return the first and last lines to scan in editor"""
+    try:
+        first = editor.GetFirstVisibleLine()
+        return first, first + editor.GetNumberOfVisibleLines()
+    except Exception:
+        start, end = editor.GetSelection()
+        first = document.GetLineNumberFromPosition(start)
+        return max(first - _kVisibleLines // 2, 0), first + _kVisibleLines // 2
+
+def _scan_line(line_txt, dirname):
+    """Return [(start col, end col, resolved filename, line, col)] for the
+    existing files named in line_txt, or None if it isn't known yet whether
+    some of them exist"""
+    refs = []
+    complete = True
+    for filename, line, col, start, end in _find_all_filenames(line_txt, spans=True):
+        resolved = _resolve_filename(filename, dirname)
+        exists = _gExistsChecker.cached(resolved)
+        if exists is None:
+            _gExistsChecker.start_check(resolved)
+            complete = False
+        elif exists:
+            refs.append((start, end, resolved, line, col))
+    if not complete:
+        return None
+    return refs
+
+def _detect_filenames():
+    """Scan the visible lines of the active editor.  Runs on a timer."""
+    editor = wingapi.gApplication.GetActiveEditor()
+    if editor is None:
+        return True
+    document = editor.GetDocument()
+    doc_filename = document.GetFilename()
+    detected = _gDetected.setdefault(doc_filename, {})
+    first, last = _visible_lines(editor, document)
+    doc_last = document.GetLineNumberFromPosition(document.GetLength())
+    last = min(last, doc_last)
+    start = document.GetLineStart(first)
+    if last < doc_last:
+        end = document.GetLineStart(last + 1)
+    else:
+        end = document.GetLength()
+    lines = document.GetCharRange(start, end).split('\n')
+
+    # Forget lines that are no longer visible or have changed
+    changed = False
+    for lineno in list(detected):
+        if (lineno < first or lineno > last
+                or detected[lineno][0] != lines[lineno - first]):
+            del detected[lineno]
+            changed = True
+
+    dirname = os.path.dirname(doc_filename)
+    deadline = time.time() + _kDetectBudget
+    for lineno, line_txt in enumerate(lines[:last - first + 1], first):
+        if lineno in detected:
+            continue
+        refs = _scan_line(line_txt, dirname)
+        if refs is not None:
+            detected[lineno] = (line_txt, refs)
+            changed = changed or bool(refs)
+        if time.time() > deadline:
+            break
+    if changed:
+        _mark_detected(editor, document, first, last, detected)
+    return True
+
+def _detected_filename_at(document, pos):
+    """Return (resolved filename, line, col) for a filename detected at pos,
+    or None"""
+    detected = _gDetected.get(document.GetFilename())
+    if not detected:
+        return None
+    lineno = document.GetLineNumberFromPosition(pos)
+    if lineno not in detected:
+        return None
+    col = pos - document.GetLineStart(lineno)
+    for start, end, resolved, line, line_col in detected[lineno][1]:
+        if start <= col <= end:
+            return resolved, line, line_col
+    return None
+
+if _kDetectFilenames:
+    wingapi.gApplication.InstallTimeout(_kDetectInterval, _detect_filenames)
@@ -1,20 +1,52 @@
 """These scripts simultaneously initiate Find Uses and Batch Search, or Rename Refactoring
 and Batch Search. Two variants exist to work off the current selection or the
-last click location. """
+last click location.
+
+An index of the identifiers in the project's files is kept in the background, and the
+lines the index has for the word are shown at once in a scratch editor while Find Uses
+and Batch Search run, with the text of each line filled in as soon as it has been read.
+
+The index only finds whole identifiers with the same case, so by default Batch Search
+still looks in the whole project.  If the Search in Files tool is set to match case and
+whole words, setting _kNarrowSearch makes Batch Search look only in the deepest directory
+that holds the files containing the word, the files the index can't read (binary or
+larger than _kMaxFileSize) and the open editors containing the word.  The index is
+brought up to date first; if that takes longer than _kNarrowTimeout the whole project is
+searched. """
 
 # Written by Stephan Deibel
 
+import os
+import re
+import time
+import pickle
+import hashlib
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import wingapi
 
+# Maximum number of index lines shown by one search
+_kMaxMatches = 10000
+
+# Files larger than this are not indexed
+_kMaxFileSize = 10 * 1024 * 1024
+
+# Narrow Batch Search with the index; only set this if Search in Files is set
+# to match case and whole words, or matches will be missed
+_kNarrowSearch = False
+_kNarrowTimeout = 2.0  # seconds to wait for the index before searching everything
+
 def find_uses_and_search():
     app = wingapi.gApplication
     ed = app.GetActiveEditor()
     start, end = ed.GetSelection()
     if start == end:
         app.ExecuteCommand('select-current-word')
-    app.ExecuteCommand('find-points-of-use')
-    app.ExecuteCommand('batch-search')
-    
+    _run_and_search('find-points-of-use')
+
 find_uses_and_search.label = "Find Uses and Search"
 
 def rename_and_search():
@@ -23,9 +55,8 @@ def rename_and_search():
     start, end = ed.GetSelection()
     if start == end:
         app.ExecuteCommand('select-current-word')
-    app.ExecuteCommand('rename-symbol')
-    app.ExecuteCommand('batch-search')
-    
+    _run_and_search('rename-symbol')
+
 rename_and_search.label = "Rename and Search"
 
 def find_clicked_uses_and_search():
@@ -37,9 +68,8 @@ def find_clicked_uses_and_search():
         pos = ed.fEditor._FindPoint()[1]
     ed.SetSelection(pos, pos)
     app.ExecuteCommand('select-current-word')
-    app.ExecuteCommand('find-points-of-use')
-    app.ExecuteCommand('batch-search')
-    
+    _run_and_search('find-points-of-use')
+
 find_clicked_uses_and_search.contexts = (wingapi.kContextEditor(), )
 find_clicked_uses_and_search.label = "Find Uses and Search"
 
@@ -52,9 +82,386 @@ def rename_clicked_and_search():
         pos = ed.fEditor._FindPoint()[1]
     ed.SetSelection(pos, pos)
     app.ExecuteCommand('select-current-word')
-    app.ExecuteCommand('rename-symbol')
-    app.ExecuteCommand('batch-search')
-    
+    _run_and_search('rename-symbol')
+
 rename_clicked_and_search.contexts = (wingapi.kContextEditor(), )
 rename_clicked_and_search.label = "Rename and Search"
 
+def _run_and_search(command):
+    """Run command and Batch Search on the selected word, narrowing the
+    search with the index if _kNarrowSearch is set"""
+    app = wingapi.gApplication
+    ed = app.GetActiveEditor()
+    start, end = ed.GetSelection()
+    word = ed.GetDocument().GetCharRange(start, end)
+    index = _get_index()
+    hits = None
+    if word.strip() and index is not None:
+        hits = index.lookup(word)
+    app.ExecuteCommand(command)
+    if _kNarrowSearch and hits is not None:
+        _narrowed_batch_search(index, word)
+    else:
+        app.ExecuteCommand('batch-search')
+    if hits is not None:
+        _show_index_matches(index, word, hits)
+
+def _narrowed_batch_search(index, word):
+    """Start Batch Search for word once the index has said which files may
+    contain it, or in the whole project after _kNarrowTimeout"""
+    app = wingapi.gApplication
+    results = queue.Queue()
+    index.jobs.put(('scope', word, results))
+    deadline = time.time() + _kNarrowTimeout
+
+    def search():
+        try:
+            filenames = results.get_nowait()
+        except queue.Empty:
+            if time.time() < deadline:
+                return True
+            filenames = None
+        look_in = _search_scope(word, filenames)
+        if look_in is None:
+            app.ExecuteCommand('batch-search', search_text=word)
+        else:
+            app.ExecuteCommand('batch-search', look_in=look_in, search_text=word)
+        return False
+
+    app.InstallTimeout(20, search)
+
+def _search_scope(word, filenames):
+    """Return the directory Batch Search needs to look in to find word, or
+    None to search the whole project.  filenames are the saved files that may
+    contain word, from the index; open editors may have unsaved matches
+    elsewhere."""
+    if filenames is None:
+        return None
+    regex = re.compile(r'(?<!\w)%s(?!\w)' % re.escape(word))
+    filenames = list(filenames)
+    for doc in wingapi.gApplication.GetOpenDocuments():
+        if regex.search(doc.GetText()):
+            filenames.append(doc.GetFilename())
+    filenames = [fn for fn in filenames if os.path.isabs(fn)]
+    if not filenames:
+        return None
+    look_in = os.path.dirname(filenames[0])
+    for filename in filenames[1:]:
+        while not filename.startswith(look_in.rstrip(os.sep) + os.sep):
+            if look_in == os.path.dirname(look_in):
+                return None
+            look_in = os.path.dirname(look_in)
+    project_fn = wingapi.gApplication.GetProject().GetFilename()
+    if os.path.isabs(project_fn):
+        project_dir = os.path.dirname(project_fn)
+        if not look_in.startswith(project_dir.rstrip(os.sep) + os.sep):
+            return None
+    return look_in
+
+def _show_index_matches(index, word, hits):
+    """Show the lines the index has for word in a scratch editor: at once
+    as file:line, then with the text of each line once the index thread has
+    read it"""
+    app = wingapi.gApplication
+    # Not raised, so the Find Uses or Rename results stay in view
+    editor = app.ScratchEditor("Search: %s" % word, 'text/plain', raise_view=False)
+    doc = editor.GetDocument()
+    header = "Indexed lines for %s:\n\n" % word
+    lines = ['%s:%d:\n' % (fn, lineno) for fn in sorted(hits) for lineno in hits[fn]]
+    if len(lines) > _kMaxMatches:
+        lines = lines[:_kMaxMatches] + ['...\n']
+    doc.SetText(header + ''.join(lines))
+    results = queue.Queue()
+    index.jobs.put(('lines', hits, results))
+
+    def show_text():
+        try:
+            lines = results.get_nowait()
+        except queue.Empty:
+            return True
+        doc.SetText(header + ''.join(lines))
+        return False
+
+    app.InstallTimeout(50, show_text)
+
+# Index of the identifiers in the project's files, built on a background
+# thread and saved in the User Settings Directory between sessions.  Files
+# are indexed again when saved in Wing, and the modification times of all
+# files are checked every _kRescanInterval seconds to catch changes made
+# outside of Wing.  Lookups return None until the index is complete.
+# Files that can't be indexed are recorded with None instead of their
+# identifiers, so narrowed searches can include them.
+
+_kUseIndex = True
+_kRescanInterval = 60  # seconds
+_kSaveInterval = 30  # seconds between saves of a changed index
+_kIdentifierRE = re.compile(r'[^\W\d]\w*', re.UNICODE)
+_kIndexVersion = 2
+
+def _index_text(txt):
+    """Return {identifier: [line numbers]} for txt"""
+    identifiers = {}
+    for lineno, line in enumerate(txt.splitlines(), 1):
+        for identifier in set(_kIdentifierRE.findall(line)):
+            identifiers.setdefault(identifier, []).append(lineno)
+    return identifiers
+
+class _IdentifierIndex(threading.Thread):
+    """Inverted index from identifier to {filename: [line numbers]}.  Jobs
+    are ('files', filenames) for the project's files, ('update', filename)
+    for a file that changed, ('scope', word, results queue) to bring the
+    index up to date and put the files that may contain word on the queue,
+    ('lines', {filename: [line numbers]}, results queue) to put the
+    file:line: text lines for those lines on the queue, and ('stop',).  Errors are put on errors as
+    (job, message) and reported on the main thread by _report_index_errors()."""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.jobs = queue.Queue()
+        self.errors = queue.Queue()
+        self.lock = threading.Lock()
+        self.project = None
+        self.filename = None  # where the index is saved
+        self.files = {}  # filename -> (mtime, size, {identifier: [line numbers]} or None)
+        self.postings = {}  # identifier -> {filename: [line numbers]}
+        self.skipped = set()  # files whose identifiers are None
+        self.project_files = []
+        self.ready = False
+        self.dirty = False
+        self.last_save = 0
+        self.last_scan = 0
+
+    def _load(self):
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                data = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            return
+        if data.get('version') != _kIndexVersion:
+            return
+        with self.lock:
+            for filename, entry in data['files'].items():
+                self._set(filename, entry)
+
+    def _save(self):
+        # Set first so that a failing save is retried on the next interval
+        self.last_save = time.time()
+        with self.lock:
+            data = {'version': _kIndexVersion, 'files': dict(self.files)}
+            self.dirty = False
+        tmp_filename = self.filename + '.tmp'
+        f = open(tmp_filename, 'wb')
+        try:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        if os.path.exists(self.filename) and os.name == 'nt':
+            os.remove(self.filename)
+        os.rename(tmp_filename, self.filename)
+
+    def _set(self, filename, entry):
+        """Replace the entry for filename; must be called with the lock held"""
+        old = self.files.pop(filename, None)
+        self.skipped.discard(filename)
+        if old is not None:
+            for identifier in old[2] or ():
+                files = self.postings.get(identifier)
+                if files is not None:
+                    files.pop(filename, None)
+                    if not files:
+                        del self.postings[identifier]
+        if entry is not None and entry[2] is None:
+            self.files[filename] = entry
+            self.skipped.add(filename)
+        elif entry is not None:
+            self.files[filename] = entry
+            for identifier, linenos in entry[2].items():
+                self.postings.setdefault(identifier, {})[filename] = linenos
+        self.dirty = True
+
+    def _index_file(self, filename, force=False):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            with self.lock:
+                if filename in self.files:
+                    self._set(filename, None)
+            return
+        old = self.files.get(filename)
+        if not force and old is not None and old[:2] == (st.st_mtime, st.st_size):
+            return
+        entry = (st.st_mtime, st.st_size, None)
+        if st.st_size <= _kMaxFileSize:
+            try:
+                f = open(filename, 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+            except (IOError, OSError):
+                data = b'\0'
+            if b'\0' not in data[:1024]:
+                entry = (st.st_mtime, st.st_size, _index_text(data.decode('utf-8', 'replace')))
+        with self.lock:
+            self._set(filename, entry)
+
+    def _scan(self):
+        """Index the project's files that changed since they were indexed"""
+        for filename in self.project_files:
+            self._index_file(filename)
+        known = set(self.project_files)
+        with self.lock:
+            for filename in [fn for fn in self.files if fn not in known]:
+                self._set(filename, None)
+            self.ready = True
+        self.last_scan = time.time()
+
+    def run(self):
+        self._load()
+        while True:
+            try:
+                job = self.jobs.get(timeout=_kSaveInterval)
+            except queue.Empty:
+                job = None
+            try:
+                if job is not None and job[0] == 'stop':
+                    return
+                if job is not None and job[0] == 'files':
+                    self.project_files = job[1]
+                    with self.lock:
+                        self.ready = False
+                    self._scan()
+                elif job is not None and job[0] == 'update':
+                    self._index_file(job[1], force=True)
+                elif job is not None and job[0] == 'scope':
+                    job[2].put(self._scope(job[1]))
+                elif job is not None and job[0] == 'lines':
+                    job[2].put(_read_lines(job[1]))
+                elif self.project_files and time.time() - self.last_scan > _kRescanInterval:
+                    # This also retries a scan that failed; until then
+                    # lookups return None
+                    self._scan()
+            except Exception as e:
+                self.errors.put((job and job[0] or 'scan', str(e)))
+            try:
+                if self.dirty and time.time() - self.last_save > _kSaveInterval:
+                    self._save()
+            except Exception as e:
+                self.errors.put(('save', str(e)))
+
+    def _scope(self, word):
+        """Return the project files that may contain word once the index is
+        up to date, or None if it can't tell"""
+        self._scan()
+        with self.lock:
+            if not self.ready:
+                return None
+            return list(self.postings.get(word, {})) + list(self.skipped)
+
+    def lookup(self, word):
+        """Return {filename: [line numbers]} for an identifier, or None if the
+        index can't answer yet"""
+        match = _kIdentifierRE.match(word)
+        if match is None or match.end() != len(word):
+            return None
+        with self.lock:
+            if not self.ready:
+                return None
+            return dict(self.postings.get(word, {}))
+
+def _read_lines(hits):
+    """Return 'file:line: text' lines for {filename: [line numbers]}, up to
+    _kMaxMatches of them"""
+    lines = []
+    for filename in sorted(hits):
+        if len(lines) >= _kMaxMatches:
+            lines.append('...\n')
+            break
+        try:
+            f = open(filename, 'rb')
+            try:
+                txt = f.read().decode('utf-8', 'replace').splitlines()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            txt = []
+        for lineno in hits[filename][:_kMaxMatches - len(lines)]:
+            if lineno <= len(txt):
+                lines.append('%s:%d: %s\n' % (filename, lineno, txt[lineno - 1]))
+            else:
+                lines.append('%s:%d:\n' % (filename, lineno))
+    return lines
+
+_gIndex = None
+_gIndexSignals = []
+_gReportedErrors = set()
+
+def _report_index_errors():
+    """Show the errors of the index thread that haven't been shown yet.  Runs
+    on a timer."""
+    errors = []
+    while _gIndex is not None:
+        try:
+            error = '%s: %s' % _gIndex.errors.get_nowait()
+        except queue.Empty:
+            break
+        # A failing save is retried every interval; say so once
+        if error not in _gReportedErrors:
+            _gReportedErrors.add(error)
+            errors.append(error)
+    if errors:
+        wingapi.gApplication.ShowMessageDialog("Identifier Index Failed", '\n'.join(errors))
+    return True
+
+def _get_index():
+    """Return the identifier index for the current project, starting it if
+    needed, or None if not enabled"""
+    global _gIndex
+    if not _kUseIndex:
+        return None
+    app = wingapi.gApplication
+    project_fn = app.GetProject().GetFilename()
+    if _gIndex is None or _gIndex.project != project_fn:
+        if _gIndex is not None:
+            _gIndex.jobs.put(('stop',))
+        _gIndex = _IdentifierIndex()
+        _gIndex.project = project_fn
+        _gIndex.filename = os.path.join(
+            app.GetUserSettingsDir(),
+            'x_and_search-%s.idx' % hashlib.sha1(project_fn.encode('utf-8')).hexdigest()[:16])
+        _gIndex.start()
+        _on_project_files_changed()
+        for obj, signal in _gIndexSignals:
+            obj.Disconnect(signal)
+        project = app.GetProject()
+        _gIndexSignals[:] = [
+            (project, project.Connect('files-added', _on_project_files_changed)),
+            (project, project.Connect('files-removed', _on_project_files_changed)),
+        ]
+    return _gIndex
+
+def _on_project_files_changed(*args):
+    if _gIndex is not None:
+        _gIndex.jobs.put(('files', list(wingapi.gApplication.GetProject().GetAllFiles())))
+
+def _on_save_point(doc, savepoint):
+    if savepoint and _gIndex is not None:
+        _gIndex.jobs.put(('update', doc.GetFilename()))
+
+def _connect_to_document(doc):
+    doc.Connect('save-point', lambda savepoint: _on_save_point(doc, savepoint))
+
+def _init():
+    app = wingapi.gApplication
+    app.Connect('document-open', _connect_to_document)
+    for doc in app.GetOpenDocuments():
+        _connect_to_document(doc)
+    app.Connect('project-open', lambda *args: _get_index())
+    app.InstallTimeout(1000, _report_index_errors)
+    _get_index()
+
+_init()
@@ -1,51 +1,350 @@
-# This script generates *.pi files for auto-completion w/ Autodesk's Maya. 
-# It should be run with Maya's standalone python interpreter -- bin\mayapy.exe 
-# in the Maya install directory.
-
-
-import os
-import sys
-import maya.standalone
-
-WING_DIR = r'c:\Program Files (x86)\Wing IDE 3.2'
-if not os.path.exists(WING_DIR):
-    WING_DIR = r'c:\Program Files\Wing IDE 3.2'
-
-sys.path.append(os.path.join(WING_DIR, 'src', 'wingutils'))
-import generate_pi
-
-PI_FILES_DIR = os.path.join(os.environ['AppData'], 'Wing IDE 3', 'pi-files')
-MOD_LIST = [
-    'maya.OpenMaya',
-    'maya.OpenMayaAnim',
-    'maya.OpenMayaCloth',
-    'maya.OpenMayaFX',
-    'maya.OpenMayaMPx',
-    'maya.OpenMayaRender',
-    'maya.OpenMayaUI',
-    'maya.cmds',
-    'maya.standalone',
-    ]
-
-
-def main():
-    
-                    
-    maya.standalone.initialize()
-    
-    for mod in MOD_LIST:
-        
-        pi_filename = os.path.join(PI_FILES_DIR, os.sep.join(mod.split('.')) + '.pi')
-        if not os.path.isdir(os.path.dirname(pi_filename)):
-            os.makedirs(os.path.dirname(pi_filename))
-            
-        print 'Generating .pi file for', mod
-
-        f = open(pi_filename, 'w')
-        try:
-            generate_pi.ProcessModule(mod, file=f)
-        finally:
-            f.close()
-    
-if __name__ == '__main__':
-    main()
+# This script generates *.pi files for auto-completion w/ Autodesk's Maya or
+# any other package that ships compiled extension modules (vendor SDKs, etc).
+# For Maya it should be run with Maya's standalone python interpreter --
+# bin\mayapy.exe (or bin/mayapy on Linux) in the Maya install directory.
+#
+# Usage:
+#
+#   mayapy genmayapi.py [options] [package ...]
+#
+# Packages default to 'maya'.  The extension submodules of each package are
+# discovered on disk and the *.pi files are generated in parallel worker
+# processes.  Recognized options:
+#
+#   --wing-dir=DIR   Wing installation directory; defaults to $WINGHOME or
+#                    the old Windows install locations
+#   --pi-dir=DIR     root of the pi-files tree to write into; defaults to the
+#                    pi-files directory in the Wing user settings directory
+#   --jobs=N         number of worker processes; defaults to the CPU count
+#   --module=NAME    also generate a *.pi file for NAME (may be repeated)
+#   --harvest-docs   collect cmds.help() text for the maya.cmds stubs; the
+#                    text is cached per Maya version so only the first run
+#                    for a version pays for it
+#   --doc-cache=DIR  directory for the harvested docs cache; defaults to
+#                    genmayapi-cache next to the pi-files directory
+
+from __future__ import print_function
+
+import io
+import os
+import re
+import sys
+import json
+import multiprocessing
+
+WING_DIR = os.environ.get('WINGHOME')
+if WING_DIR is None:
+    WING_DIR = r'c:\Program Files (x86)\Wing IDE 3.2'
+    if not os.path.exists(WING_DIR):
+        WING_DIR = r'c:\Program Files\Wing IDE 3.2'
+
+if 'AppData' in os.environ:
+    PI_FILES_DIR = os.path.join(os.environ['AppData'], 'Wing IDE 3', 'pi-files')
+else:
+    PI_FILES_DIR = os.path.join(os.path.expanduser('~'), '.wingide3', 'pi-files')
+
+DOC_CACHE_DIR = os.path.join(os.path.dirname(PI_FILES_DIR), 'genmayapi-cache')
+
+# Number of maya commands to ask for help text per worker task
+HARVEST_CHUNK_SIZE = 100
+
+# Modules that cannot be found by looking for extension modules on disk,
+# because they are populated at runtime
+MOD_LIST = [
+    'maya.cmds',
+    'maya.standalone',
+    ]
+
+# Per-package extra modules and the function that has to be called in each
+# worker process before the package's modules can be imported
+PACKAGE_EXTRA_MODULES = {
+    'maya': MOD_LIST,
+    }
+PACKAGE_INIT = {
+    'maya': 'maya.standalone.initialize',
+    }
+
+def _extension_suffixes():
+    """Return the file name suffixes used by compiled extension modules."""
+    try:
+        import importlib.machinery
+        return tuple(importlib.machinery.EXTENSION_SUFFIXES)
+    except ImportError:
+        import imp
+        return tuple([s for s, m, t in imp.get_suffixes() if t == imp.C_EXTENSION])
+
+def _is_package_dir(dirname, suffixes):
+    for name in os.listdir(dirname):
+        if name in ('__init__.py', '__init__.pyc'):
+            return True
+        for suffix in suffixes:
+            if name == '__init__' + suffix:
+                return True
+    return False
+
+def discover_modules(package):
+    """Find the compiled extension submodules of the given package without
+    importing them.  SWIG-style wrappers (foo.py next to _foo.so) are listed
+    under the wrapper's name since that is what user code imports."""
+
+    suffixes = _extension_suffixes()
+    pkg = __import__(package, fromlist=['__name__'])
+    paths = getattr(pkg, '__path__', None)
+    if paths is None:
+        return [package]
+
+    mod_list = []
+    for path in paths:
+        for dirname, subdirs, filenames in os.walk(path):
+            if dirname != path and not _is_package_dir(dirname, suffixes):
+                subdirs[:] = []
+                continue
+            rel = os.path.relpath(dirname, path)
+            prefix = package if rel == os.curdir else '.'.join([package] + rel.split(os.sep))
+            filenames = set(filenames)
+            for filename in sorted(filenames):
+                for suffix in suffixes:
+                    if filename.endswith(suffix):
+                        name = filename[:-len(suffix)]
+                        break
+                else:
+                    continue
+                if name == '__init__':
+                    mod_list.append(prefix)
+                elif name.startswith('_') and name[1:] + '.py' in filenames:
+                    mod_list.append(prefix + '.' + name[1:])
+                else:
+                    mod_list.append(prefix + '.' + name)
+
+    mod_list.extend(PACKAGE_EXTRA_MODULES.get(package, []))
+    return sorted(set(mod_list))
+
+def find_generate_pi_dir(wing_dir):
+    """Return the directory within the Wing installation that contains
+    generate_pi.py"""
+    for subdir in (('src', 'wingutils'), ('bin', 'wingutils'), ('wingutils',)):
+        dirname = os.path.join(wing_dir, *subdir)
+        if os.path.isfile(os.path.join(dirname, 'generate_pi.py')):
+            return dirname
+    return None
+
+def pi_filename_for(pi_dir, mod):
+    return os.path.join(pi_dir, os.sep.join(mod.split('.')) + '.pi')
+
+# Worker process state, set up by _init_worker
+_generate_pi = None
+
+def _init_worker(generate_pi_dir, init_funcs):
+    global _generate_pi
+    sys.path.append(generate_pi_dir)
+    import generate_pi
+    _generate_pi = generate_pi
+    for init_func in init_funcs:
+        mod_name, func_name = init_func.rsplit('.', 1)
+        mod = __import__(mod_name, fromlist=[func_name])
+        getattr(mod, func_name)()
+
+def _replace(src, dst):
+    """Rename src over dst, which os.rename only does atomically on POSIX"""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+def _generate_one(args):
+    """Generate the *.pi file for one module in a worker process.  Returns
+    (module name, error message or None)."""
+
+    mod, pi_filename = args
+    tmp_filename = '%s.%d.tmp' % (pi_filename, os.getpid())
+    try:
+        f = open(tmp_filename, 'w')
+        try:
+            _generate_pi.ProcessModule(mod, file=f)
+        finally:
+            f.close()
+        _replace(tmp_filename, pi_filename)
+    except Exception as exc:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        return mod, '%s: %s' % (exc.__class__.__name__, exc)
+    return mod, None
+
+def _maya_commands():
+    """Return (maya version, list of command names) in a worker process."""
+    import maya.cmds
+    version = '%s-%s' % (maya.cmds.about(version=True), maya.cmds.about(apiVersion=True))
+    names = [n for n in dir(maya.cmds) if not n.startswith('_')
+             and callable(getattr(maya.cmds, n))]
+    return version, names
+
+def _harvest_help(names):
+    """Return ({command name: help text}, [names of commands without help])
+    for the given maya commands in a worker process.  Commands whose help
+    failed are in neither, so they are tried again next time."""
+    import maya.cmds
+    docs = {}
+    empty = []
+    for name in names:
+        try:
+            text = maya.cmds.help(name)
+        except Exception:
+            continue
+        if text and text.strip():
+            docs[name] = text.strip()
+        else:
+            empty.append(name)
+    return docs, empty
+
+def _doc_cache_filename(doc_cache_dir, version):
+    version = re.sub(r'[^\w.-]', '_', version)
+    return os.path.join(doc_cache_dir, 'maya-cmds-help-%s.json' % version)
+
+def harvest_maya_docs(pool, doc_cache_dir):
+    """Return the {command name: help text} mapping for maya.cmds, reading
+    the cache for the running Maya version and asking the workers in pool for
+    the help text of any commands not in it yet."""
+
+    version, names = pool.apply(_maya_commands)
+    cache_filename = _doc_cache_filename(doc_cache_dir, version)
+    docs = {}
+    missing = set()
+    if os.path.exists(cache_filename):
+        with open(cache_filename) as f:
+            cache = json.load(f)
+        docs = cache['docs']
+        missing = set(cache['missing'])
+
+    todo = [n for n in names if n not in docs and n not in missing]
+    if not todo:
+        return docs
+
+    print('Harvesting help for', len(todo), 'maya commands')
+    chunks = [todo[i:i + HARVEST_CHUNK_SIZE] for i in range(0, len(todo), HARVEST_CHUNK_SIZE)]
+    for chunk_docs, chunk_empty in pool.imap_unordered(_harvest_help, chunks):
+        docs.update(chunk_docs)
+        missing.update(chunk_empty)
+
+    if not os.path.isdir(doc_cache_dir):
+        os.makedirs(doc_cache_dir)
+    tmp_filename = cache_filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump({'docs': docs, 'missing': sorted(missing)}, f)
+    _replace(tmp_filename, cache_filename)
+    return docs
+
+_re_def = re.compile(r'^def (\w+)\(.*:\s*$')
+
+def embed_docstrings(pi_filename, docs):
+    """Add docstrings from docs to the top-level functions in the given *.pi
+    file that don't already have one."""
+
+    # Help text from json is unicode under Python 2 as well
+    with io.open(pi_filename, encoding='utf-8') as f:
+        lines = f.read().split('\n')
+    out = []
+    for i, line in enumerate(lines):
+        out.append(line)
+        m = _re_def.match(line)
+        if m is None or m.group(1) not in docs:
+            continue
+        body = lines[i + 1] if i + 1 < len(lines) else ''
+        if body.lstrip().startswith(('"', "'")):
+            continue
+        indent = body[:len(body) - len(body.lstrip())] or '  '
+        text = docs[m.group(1)].replace('\\', '\\\\').replace('"""', '\\"\\"\\"')
+        if text.endswith('"'):
+            text += ' '
+        text = ('\n' + indent).join(text.split('\n'))
+        out.append('%s"""%s"""' % (indent, text))
+    with io.open(pi_filename, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(out))
+
+def generate(packages, pi_dir, generate_pi_dir, jobs=None, extra_modules=(),
+             doc_cache_dir=None):
+    """Generate *.pi files for the extension modules of the given packages
+    into the pi-files tree at pi_dir, using jobs worker processes.  If
+    doc_cache_dir is given, the help text for maya.cmds is harvested (or read
+    from the cache there) and added to its stubs.  Returns the list of
+    (module name, error message) for modules that failed."""
+
+    init_funcs = [PACKAGE_INIT[p] for p in packages if p in PACKAGE_INIT]
+
+    mod_list = []
+    for package in packages:
+        mod_list.extend(discover_modules(package))
+    mod_list.extend(extra_modules)
+    mod_list = sorted(set(mod_list))
+
+    work = []
+    for mod in mod_list:
+        pi_filename = pi_filename_for(pi_dir, mod)
+        if not os.path.isdir(os.path.dirname(pi_filename)):
+            os.makedirs(os.path.dirname(pi_filename))
+        work.append((mod, pi_filename))
+
+    errors = []
+    docs = None
+    pool = multiprocessing.Pool(jobs, _init_worker, (generate_pi_dir, init_funcs))
+    try:
+        if doc_cache_dir is not None and 'maya.cmds' in mod_list:
+            docs = harvest_maya_docs(pool, doc_cache_dir)
+        for mod, error in pool.imap_unordered(_generate_one, work):
+            if error is None:
+                print('Generated .pi file for', mod)
+            else:
+                print('Failed to generate .pi file for', mod, '--', error)
+                errors.append((mod, error))
+    finally:
+        pool.close()
+        pool.join()
+
+    if docs and 'maya.cmds' not in [mod for mod, error in errors]:
+        embed_docstrings(pi_filename_for(pi_dir, 'maya.cmds'), docs)
+    return errors
+
+def main(argv):
+
+    wing_dir = WING_DIR
+    pi_dir = PI_FILES_DIR
+    jobs = None
+    extra_modules = []
+    packages = []
+    harvest_docs = False
+    doc_cache_dir = DOC_CACHE_DIR
+    for a in argv[1:]:
+        if a.startswith('--wing-dir='):
+            wing_dir = a[len('--wing-dir='):]
+        elif a.startswith('--pi-dir='):
+            pi_dir = os.path.expanduser(a[len('--pi-dir='):])
+        elif a.startswith('--jobs='):
+            jobs = int(a[len('--jobs='):])
+        elif a.startswith('--module='):
+            extra_modules.append(a[len('--module='):])
+        elif a == '--harvest-docs':
+            harvest_docs = True
+        elif a.startswith('--doc-cache='):
+            doc_cache_dir = os.path.expanduser(a[len('--doc-cache='):])
+        elif a.startswith('-'):
+            print('Unknown option', a)
+            return 2
+        else:
+            packages.append(a)
+    if not packages and not extra_modules:
+        packages = ['maya']
+
+    generate_pi_dir = find_generate_pi_dir(wing_dir)
+    if generate_pi_dir is None:
+        print('generate_pi.py not found in', wing_dir, '-- set WINGHOME or use --wing-dir')
+        return 2
+
+    if not harvest_docs:
+        doc_cache_dir = None
+    errors = generate(packages, pi_dir, generate_pi_dir, jobs, extra_modules,
+                      doc_cache_dir)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
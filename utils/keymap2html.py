@@ -14,11 +14,31 @@
 #      assignment statement below to point to the Wing IDE executable
 #    - chdir to the directory where result files are to be created
 #    - run this script
+#
+# This file can also be imported by other scripts, which get the parsed
+# keymaps through load_keymaps(), e.g. load_keymaps()['keymap.emacs'].commands.
+# Keymaps are only parsed when first used.  After KeymapFile.use_cache(),
+# parsed and include-resolved keymaps are kept in a cache file (keymap_cache_path)
+# and reused until one of the keymap files they were read from changes.
+#
+# Besides one .html file per keymap, keymap.conflicts.txt lists bindings that
+# shadow a chord prefix (e.g. "Ctrl-X" vs. "Ctrl-X Ctrl-S") and user
+# keybindings that override or shadow a binding in each personality.
+# keymap.index.json maps each command to its keys in each personality, with
+# the user's keybindings applied, and keymap.commands.html shows the same
+# as one table across all personalities.
 
 from __future__ import with_statement # for old Python versions
 import sys
 import os
 import re
+import json
+import pickle
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping # Python 3
+except ImportError:
+    from collections import Mapping     # Python 2
 
 keymap_location = os.getenv("WINGHOME") # leave this if WINGHOME is defined
 # keymap_location = "/Applications/WingIDE.app/Contents/MacOS"
@@ -30,20 +50,24 @@ preferences_path = "~/.wingide4/preferences"
 keymap_files = ['keymap.' + mapname for mapname in
                 ('basic', 'brief', 'emacs', 'normal', 'osx', 'vi', 'visualstudio')]
 
-if not os.path.exists(keymap_location + '/keymap.basic'):
-    print('''keymap_location is not correct - it should be set to the path to the directory
-containing the wing executable; set it at the beginning of the script and rerun'''
-          .format(keymap_location))
-    sys.exit()
+# where KeymapFile.use_cache() keeps parsed keymaps between runs
+keymap_cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'keymap2html.pickle')
 
 ##########################################################################
 
 class KeymapFile(object):
 
     # To speed up include handling, here we cache already loaded objects. This maps
-    # keymap name to the KeymapFile object.
+    # keymap file path to the KeymapFile object.
     _cached_files = {}
 
+    # Cache of parsed keymaps that is kept on disk; maps keymap file path to
+    # ({path: mtime} for the file and its includes, [(key, command)]).  None
+    # unless use_cache() was called.
+    _persistent_cache = None
+    _persistent_cache_path = None
+    _persistent_cache_dirty = False
+
     @classmethod
     def load(cls, keymap_name):
         """
@@ -52,13 +76,60 @@ class KeymapFile(object):
         map = KeymapFile.load("keymap.brief")
 
         """
-        obj =  cls._cached_files.get(keymap_name, None)
+        path = os.path.join(keymap_location, keymap_name)
+        obj =  cls._cached_files.get(path, None)
         if obj:
             return obj
-        obj = KeymapFile(keymap_name)
-        cls._cached_files[keymap_name] = obj
+        if cls._persistent_cache is not None:
+            entry = cls._persistent_cache.get(path)
+            if entry is not None and _files_unchanged(entry[0]):
+                obj = cls.__new__(cls)
+                obj.files = entry[0]
+                obj.commands = OrderedDict(entry[1])
+        if obj is None:
+            obj = KeymapFile(keymap_name)
+            if cls._persistent_cache is not None:
+                cls._persistent_cache[path] = (obj.files, list(obj.commands.items()))
+                cls._persistent_cache_dirty = True
+        cls._cached_files[path] = obj
         return obj
 
+    @classmethod
+    def use_cache(cls, cache_path=None):
+        """Read parsed keymaps from the cache file and keep newly parsed ones
+        in it; call save_cache() to write it back."""
+        if cache_path is None:
+            cache_path = keymap_cache_path
+        cls._persistent_cache_path = cache_path
+        cls._persistent_cache = {}
+        cls._persistent_cache_dirty = False
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    cls._persistent_cache = pickle.load(f)
+            except Exception:
+                # Unreadable or from an incompatible version: start over
+                cls._persistent_cache_dirty = True
+
+    @classmethod
+    def save_cache(cls):
+        if cls._persistent_cache is None or not cls._persistent_cache_dirty:
+            return
+        cache_dir = os.path.dirname(cls._persistent_cache_path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = cls._persistent_cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(cls._persistent_cache, f, 2)
+        if hasattr(os, 'replace'):
+            os.replace(tmp_path, cls._persistent_cache_path)
+        else:
+            # os.rename only replaces an existing file on POSIX
+            if os.name == 'nt' and os.path.exists(cls._persistent_cache_path):
+                os.remove(cls._persistent_cache_path)
+            os.rename(tmp_path, cls._persistent_cache_path)
+        cls._persistent_cache_dirty = False
+
     def __init__(self, fname):
         """
         Do not use this constructor, call KeymapFile.load() instead.
@@ -69,12 +140,13 @@ class KeymapFile(object):
         re_mapping = re.compile(r"^'([^']+)'\s*:\s*(['\"])(.+)\2")
         re_include = re.compile(r"^\%include\s+(\S+)")
 
-        # List of assigned keys in order of reading
-        self.keys = []
-        # Mapping of keys to commands
-        self.commands = {}
+        # Mapping of keys to commands, in order of reading
+        self.commands = OrderedDict()
+        # Modification times of this file and the files it includes
+        path = os.path.join(keymap_location, fname)
+        self.files = {path: os.path.getmtime(path)}
 
-        with open(os.path.join(keymap_location, fname)) as f:
+        with open(path) as f:
             for line in f.readlines():
                 line = line.strip()
                 if not line:
@@ -93,19 +165,22 @@ class KeymapFile(object):
                     continue
                 raise Exception("Unknown line: file {}, line {}".format(fname, line))
 
+    @property
+    def keys(self):
+        """List of assigned keys in order of reading"""
+        return list(self.commands)
+
     def _add_mapping(self, key, command):
-        # Removing previous key entry if any
-        if key in self.keys:
-            self.keys.remove(key)
-        # Addding this one
-        self.keys.append(key)
-        # Saving command
+        # Removing previous key entry if any, so the key moves to the end
+        if key in self.commands:
+            del self.commands[key]
         self.commands[key] = command
 
     def _import_mappings(self, importFromName):
         importFrom = self.load(importFromName)
-        for key in importFrom.keys:
-            self._add_mapping(key, importFrom.commands[key])
+        self.files.update(importFrom.files)
+        for key, command in importFrom.commands.items():
+            self._add_mapping(key, command)
 
     def text_report(self, filelike):
         for key in self.keys:
@@ -118,6 +193,40 @@ class KeymapFile(object):
             filelike.write( "<tr><td>%s</td><td>%s</td></tr>" % (key, self.commands[key]) )
         filelike.write("</table></body></html>\n")
 
+def _files_unchanged(files):
+    for path, mtime in files.items():
+        try:
+            if os.path.getmtime(path) != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+class LazyKeymaps(Mapping):
+    """Read-only mapping of keymap name to KeymapFile that only loads a keymap
+    when it is first accessed"""
+
+    def __init__(self, names):
+        self._names = list(names)
+
+    def __getitem__(self, name):
+        if name not in self._names:
+            raise KeyError(name)
+        return KeymapFile.load(name)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+def load_keymaps(names=None):
+    """Return a LazyKeymaps for the given keymap names, by default all of
+    Wing's keyboard personalities"""
+    if names is None:
+        names = keymap_files
+    return LazyKeymaps(names)
+
 try:
     import configparser                 # Python 3
 except:
@@ -132,8 +241,7 @@ except:
 class UserKeymap(KeymapFile):
     """Extract the user settings from the WingIDE preferences file"""
     def __init__(self):
-        self.keys = []
-        self.commands = {}
+        self.commands = OrderedDict()
 
     def load(self):
         prefpath = os.path.expanduser(preferences_path)
@@ -151,14 +259,205 @@ class UserKeymap(KeymapFile):
         else:
             print('No user keybindings found in preferences file - not generating User keymap table')
 
+def _split_chord(key):
+    """Split a key binding into its strokes, e.g. "Ctrl-X Ctrl-S".  Named
+    keys are compared case insensitively (Right vs right), single characters
+    are not."""
+    strokes = []
+    for stroke in key.split():
+        parts = stroke.split('-')
+        if len(parts[-1]) > 1:
+            parts[-1] = parts[-1].lower()
+        strokes.append('-'.join(parts))
+    return tuple(strokes)
+
+class ChordTrie(object):
+    """Trie over the strokes of multi-stroke key bindings.  Each node is a
+    [key, command, children] list, where key and command are None for nodes
+    that are only a prefix of other bindings."""
+
+    def __init__(self):
+        self.root = [None, None, {}]
+
+    def insert(self, key, command):
+        """Add a binding and return the list of (key, command) for existing
+        bindings it conflicts with: bindings that are a chord prefix of the
+        new key and bindings that the new key is a chord prefix of."""
+        conflicts = []
+        node = self.root
+        for stroke in _split_chord(key):
+            if node[0] is not None:
+                conflicts.append((node[0], node[1]))
+            node = node[2].setdefault(stroke, [None, None, {}])
+        conflicts.extend(self._bindings_below(node))
+        node[0], node[1] = key, command
+        return conflicts
+
+    def find(self, key):
+        """Return (key, command) for the binding with the same strokes as
+        key, or None"""
+        node = self.root
+        for stroke in _split_chord(key):
+            node = node[2].get(stroke)
+            if node is None:
+                return None
+        if node[0] is None:
+            return None
+        return node[0], node[1]
+
+    def prefix_conflicts(self, key):
+        """Like insert() but without adding the binding"""
+        conflicts = []
+        node = self.root
+        for stroke in _split_chord(key):
+            if node[0] is not None:
+                conflicts.append((node[0], node[1]))
+            node = node[2].get(stroke)
+            if node is None:
+                return conflicts
+        return conflicts + self._bindings_below(node)
+
+    def _bindings_below(self, node):
+        found = []
+        stack = list(node[2].values())
+        while stack:
+            child = stack.pop()
+            if child[0] is not None:
+                found.append((child[0], child[1]))
+            stack.extend(child[2].values())
+        return found
+
+def find_conflicts(keymaps, usermap=None):
+    """Check the given {name: KeymapFile} personalities and the optional
+    user keymap in one pass over each personality's bindings.  Returns a list
+    of (keymap name, kind, key, command, other key, other command) tuples
+    where kind is one of:
+
+      'prefix' -- key is a chord prefix of other key (or the reverse) so one
+                  of the two bindings can never be typed
+      'override' -- the user binding for key replaces the personality's
+                    binding, possibly with the same command
+      'user-prefix' -- a user binding and a personality binding are chord
+                       prefixes of each other
+      'unbind' -- the user binding for key is None, which removes the
+                  personality's binding
+    """
+    conflicts = []
+    for name, keymap in keymaps.items():
+        trie = ChordTrie()
+        for key, command in keymap.commands.items():
+            for other_key, other_command in trie.insert(key, command):
+                conflicts.append((name, 'prefix', key, command, other_key, other_command))
+        if usermap is None:
+            continue
+        for key, command in usermap.commands.items():
+            found = trie.find(key)
+            if command is None:
+                # An unbound key can't shadow anything
+                if found is not None:
+                    conflicts.append((name, 'unbind', key, command) + found)
+                continue
+            if found is not None:
+                conflicts.append((name, 'override', key, command) + found)
+                continue
+            for other_key, other_command in trie.prefix_conflicts(key):
+                conflicts.append((name, 'user-prefix', key, command, other_key, other_command))
+    return conflicts
+
+def report_conflicts(conflicts, filelike):
+    for name, kind, key, command, other_key, other_command in conflicts:
+        filelike.write("%s: %s: %s (%s) vs %s (%s)\n" % (name, kind, key, command,
+                                                        other_key, other_command))
+
+def _split_commands(command):
+    """Split a binding's value into the commands it tries in turn, e.g.
+    'forward-syllable, forward-word'.  None (an unbound key) has none."""
+    if command is None:
+        return []
+    return [c.strip() for c in command.split(',') if c.strip()]
+
+def build_command_index(keymaps, usermap=None):
+    """Build the reverse index {command: {keymap name: [keys]}} for the
+    given {name: KeymapFile} personalities.  With a user keymap, each
+    personality's keys are those in effect after applying the user's
+    overrides (a None binding unbinds the key), and the user's own bindings
+    are listed under 'keymap.user'."""
+    index = {}
+    layers = list(keymaps.items())
+    if usermap is not None:
+        layers.append(('keymap.user', usermap))
+    for name, keymap in layers:
+        commands = keymap.commands
+        if usermap is not None and keymap is not usermap:
+            commands = OrderedDict(commands)
+            for key, command in usermap.commands.items():
+                if command is None:
+                    commands.pop(key, None)
+                else:
+                    commands[key] = command
+        for key, command in commands.items():
+            for cmd in _split_commands(command):
+                index.setdefault(cmd, {}).setdefault(name, []).append(key)
+    for personalities in index.values():
+        for keys in personalities.values():
+            keys.sort()
+    return index
+
+def write_command_index(index, filelike):
+    """Write the index from build_command_index() as compact JSON"""
+    json.dump(index, filelike, sort_keys=True, separators=(',', ':'))
+
+def load_command_index(filename):
+    """Read an index written by write_command_index(), e.g. to look up what
+    a command is bound to from within the IDE: index['batch-search']"""
+    with open(filename) as f:
+        return json.load(f)
+
+def _html_escape(txt):
+    return txt.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def command_index_html_report(index, keymap_names, filelike):
+    filelike.write("<html><body><table><th><tr><td>Command</td>")
+    for name in keymap_names:
+        filelike.write("<td>%s</td>" % name)
+    filelike.write("</tr></th>")
+    for command in sorted(index):
+        filelike.write("<tr><td>%s</td>" % _html_escape(command))
+        for name in keymap_names:
+            keys = index[command].get(name, [])
+            filelike.write("<td>%s</td>" % '<br>'.join([_html_escape(k) for k in keys]))
+        filelike.write("</tr>")
+    filelike.write("</table></body></html>\n")
+
 def report_keymap(keymap_name, keymap):
     print("*** %s ***" % keymap_name)
     #m.text_report(sys.stdout)
     with open(keymap_name + '.html', 'w') as keymap_file:
         keymap.html_report(keymap_file)
 
-for keymap_name in keymap_files:
-    report_keymap(keymap_name, KeymapFile.load(keymap_name))
-usermap = UserKeymap().load()
-if usermap:
-    keymap = report_keymap('keymap.user', usermap)
+def main():
+    if keymap_location is None or not os.path.exists(os.path.join(keymap_location, 'keymap.basic')):
+        print('''keymap_location is not correct - it should be set to the path to the directory
+containing the wing executable; set it at the beginning of the script and rerun''')
+        return 1
+
+    KeymapFile.use_cache()
+    keymaps = load_keymaps()
+    for keymap_name, keymap in keymaps.items():
+        report_keymap(keymap_name, keymap)
+    usermap = UserKeymap().load()
+    if usermap:
+        report_keymap('keymap.user', usermap)
+    with open('keymap.conflicts.txt', 'w') as conflicts_file:
+        report_conflicts(find_conflicts(keymaps, usermap), conflicts_file)
+    command_index = build_command_index(keymaps, usermap)
+    with open('keymap.index.json', 'w') as index_file:
+        write_command_index(command_index, index_file)
+    with open('keymap.commands.html', 'w') as commands_file:
+        command_index_html_report(command_index, list(keymaps) + (['keymap.user'] if usermap else []),
+                                  commands_file)
+    KeymapFile.save_cache()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())